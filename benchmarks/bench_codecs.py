@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Benchmark the compression codecs for the spec dataset
+Reports the write time, file size and the sequential and random
+read throughput for each codec on a synthetic group of spectra
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import os
+import time
+import h5py
+import numpy as np
+
+from specdb.build import utils as spbu
+from specdb.group_utils import read_rows
+
+
+def mk_spec(nspec, npix, seed=1234):
+    """ Generate synthetic spectra, padded as in the spec dataset
+
+    Parameters
+    ----------
+    nspec : int
+    npix : int
+
+    Returns
+    -------
+    data : ndarray
+    """
+    rstate = np.random.RandomState(seed)
+    dtypes = [(str('wave'), 'float64', (npix)), (str('flux'), 'float32', (npix)),
+              (str('sig'), 'float32', (npix))]
+    data = np.zeros(nspec, dtype=dtypes)
+    for ii in range(nspec):
+        ngood = rstate.randint(npix//2, npix)
+        data['wave'][ii, :ngood] = 10**(3.55 + 1e-4*np.arange(ngood))
+        data['sig'][ii, :ngood] = 0.1 + 0.05*rstate.rand()
+        data['flux'][ii, :ngood] = 1. + data['sig'][ii, :ngood]*rstate.randn(ngood)
+    return data
+
+
+def bench_codec(data, codec, chunk_rows, outfile='tmp_codec.hdf5', nrandom=200, seed=1234):
+    """ Write and read back the spectra with one codec
+
+    Returns
+    -------
+    result : dict
+    """
+    ckwargs = spbu.codec_kwargs(codec)
+    chunks = True if chunk_rows is None else (chunk_rows,)
+    # Write
+    t0 = time.time()
+    hdf = h5py.File(outfile, 'w')
+    hdf.create_dataset('spec', data=data, chunks=chunks, **ckwargs)
+    hdf.close()
+    t_write = time.time() - t0
+    size = os.path.getsize(outfile)
+    # Sequential read
+    hdf = h5py.File(outfile, 'r')
+    dset = hdf['spec']
+    t0 = time.time()
+    for ii in range(0, dset.shape[0], 100):
+        _ = dset[ii:ii+100]
+    t_seq = time.time() - t0
+    # Random read
+    rows = np.random.RandomState(seed).randint(0, dset.shape[0], nrandom)
+    t0 = time.time()
+    _ = read_rows(dset, rows)
+    t_rand = time.time() - t0
+    hdf.close()
+    os.remove(outfile)
+    return dict(write=t_write, size=size, seq=data.nbytes/1e6/t_seq,
+                rand=nrandom*data.dtype.itemsize/1e6/t_rand)
+
+
+def main(nspec=2000, npix=4000, chunk_rows=None):
+    data = mk_spec(nspec, npix)
+    print("Synthetic group of {:d} spectra, {:.1f} Mb uncompressed".format(nspec, data.nbytes/1e6))
+    print("{:14s} {:>9s} {:>10s} {:>13s} {:>13s}".format(
+        'codec', 'write (s)', 'size (Mb)', 'seq. (Mb/s)', 'random (Mb/s)'))
+    for codec in [None, 'gzip', 'gzip-shuffle', 'lzf', 'lzf-shuffle', 'blosc', 'zstd']:
+        try:
+            result = bench_codec(data, codec, chunk_rows)
+        except ImportError as err:
+            print("{:14s} skipped: {:s}".format(str(codec), str(err)))
+            continue
+        print("{:14s} {:9.2f} {:10.1f} {:13.1f} {:13.1f}".format(
+            str(codec), result['write'], result['size']/1e6, result['seq'], result['rand']))
+
+
+if __name__ == '__main__':
+    main()
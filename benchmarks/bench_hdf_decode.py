@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+""" Benchmark the decoding of byte-string columns in utils.hdf_decode
+on a synthetic meta table
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import time
+import numpy as np
+
+from astropy.table import Table, Column
+
+from specdb import utils as spdbu
+
+
+def mk_meta(nrow, seed=1234):
+    """ Generate a synthetic meta data array, similar to a large group
+
+    Parameters
+    ----------
+    nrow : int
+    seed : int, optional
+
+    Returns
+    -------
+    meta : ndarray
+      Structured array with byte-string columns
+    """
+    rstate = np.random.RandomState(seed)
+    dtype = [(str('GROUP_ID'), int), (str('zem_GROUP'), float), (str('R'), float),
+             (str('STYPE'), 'S3'), (str('INSTR'), 'S8'), (str('TELESCOPE'), 'S10'),
+             (str('DATE-OBS'), 'S10'), (str('SPEC_FILE'), 'S40')]
+    meta = np.zeros(nrow, dtype=dtype)
+    meta['GROUP_ID'] = np.arange(nrow)
+    meta['zem_GROUP'] = 5*rstate.rand(nrow)
+    meta['R'] = 2000.
+    meta['STYPE'] = b'QSO'
+    meta['INSTR'] = np.array([b'BOSS', b'SDSS', b'ESI'])[rstate.randint(0, 3, nrow)]
+    meta['TELESCOPE'] = b'SDSS 2.5-M'
+    meta['DATE-OBS'] = b'2010-03-10'
+    meta['SPEC_FILE'] = np.char.add(b'spec-', np.arange(nrow).astype('S10'))
+    return meta
+
+
+def old_decode(obj):
+    """ The original, element-by-element decoding
+    """
+    dobj = Table(obj)
+    for key in dobj.keys():
+        if 'bytes' in dobj[key].dtype.name:
+            ss = [spdbu.hdf_decode(ii) for ii in dobj[key]]
+            dobj.remove_column(key)
+            dobj[key] = Column(ss)
+    return dobj
+
+
+def main(nrow=1000000):
+    meta = mk_meta(nrow)
+    print("Decoding a meta table with {:d} rows".format(nrow))
+    # Old
+    t0 = time.time()
+    old = old_decode(meta)
+    t_old = time.time() - t0
+    print("Element by element: {:.2f} s".format(t_old))
+    # New
+    t0 = time.time()
+    new = spdbu.hdf_decode(meta, itype='Table')
+    t_new = time.time() - t0
+    print("Vectorized: {:.2f} s".format(t_new))
+    print("Speed-up: {:.1f}x".format(t_old/t_new))
+    # Check
+    for key in old.keys():
+        assert np.all(old[key] == new[key])
+
+
+if __name__ == '__main__':
+    main()
@@ -23,7 +23,10 @@ from specdb.build import utils as spbu
 from specdb.zem import utils as spzu
 from specdb import defs
 from specdb.build.utils import add_ids, write_hdf, set_sv_idkey
+from specdb.group_utils import fit_wave_solution, wave_solution_dtype, WAVE_EXPLICIT
+from specdb.column_index import META_INDEX_KEYS
 from specdb.ssa import default_fields
+from specdb.utils import hdf_decode
 
 try:
     basestring
@@ -237,13 +240,12 @@ def mk_meta(files, ztbl, fname=False, stype='QSO', skip_badz=False,
         meta[sdb_key] = [-9999]*len(meta)
         if sdb_key not in meta.keys():
             meta[sdb_key] = [-9999]*len(meta)
-        c_igmsp = SkyCoord(ra=specdb.qcat.cat['RA'], dec=specdb.qcat.cat['DEC'], unit='deg')
         c_new = SkyCoord(ra=meta['RA_GROUP'], dec=meta['DEC_GROUP'], unit='deg')
         # Find new sources
-        idx, d2d, d3d = match_coordinates_sky(c_new, c_igmsp, nthneighbor=1)
+        idx, d2d = specdb.qcat.coord_tree.match(c_new)
         cdict = defs.get_cat_dict()
         mtch = d2d < cdict['match_toler']
-        meta[sdb_key][mtch] = specdb.qcat.cat[sdb_key][idx[mtch]]
+        meta[sdb_key][mtch] = specdb.qcat.cat_column(sdb_key)[idx[mtch]]
 
     # Stack (primarily as a test)
     '''
@@ -406,9 +408,86 @@ def dumb_spec():
     return dspec
 
 
+def read_spectrum(f, badf=None, grab_conti=False):
+    """ Read one spectrum for ingestion
+
+    Parameters
+    ----------
+    f : str
+      Spectrum file
+    badf : list, optional
+      See ingest_spectra()
+    grab_conti : bool, optional
+
+    Returns
+    -------
+    wave : ndarray
+    flux : ndarray
+    sig : ndarray
+    co : ndarray or None
+      None unless grab_conti and the continuum is set
+    """
+    if badf is not None:
+        for ibadf in badf:
+            if ibadf in f:
+                spec = dumb_spec()
+            else:
+                spec = lsio.readspec(f)
+    else:
+        spec = lsio.readspec(f)
+    co = None
+    if grab_conti and spec.co_is_set:
+        co = spec.co.value
+    return spec.wavelength.value, spec.flux.value, spec.sig.value, co
+
+
+def read_spectra(files, badf=None, grab_conti=False, workers=None, verbose=False):
+    """ Read a set of spectra for ingestion, in order
+
+    Parameters
+    ----------
+    files : list
+    badf : list, optional
+    grab_conti : bool, optional
+    workers : int, optional
+      Number of processes reading the files.  At most 4*workers
+      spectra are read ahead of the one being yielded;  those not
+      yet started are cancelled if the generator is closed early
+    verbose : bool, optional
+
+    Returns
+    -------
+    spectra : generator
+      Yields the output of read_spectrum() for each file
+    """
+    if (workers is None) or (workers <= 1):
+        for f in files:
+            if verbose:
+                print(f.split('/')[-1])
+            yield read_spectrum(f, badf=badf, grab_conti=grab_conti)
+        return
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=int(workers)) as pool:
+        pending = deque()
+        try:
+            for f in files:
+                if len(pending) == 4*workers:
+                    yield pending.popleft().result()
+                if verbose:
+                    print(f.split('/')[-1])
+                pending.append(pool.submit(read_spectrum, f, badf=badf, grab_conti=grab_conti))
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:  # Stopped early;  skip the reads not yet started
+            for future in pending:
+                future.cancel()
+
+
 def ingest_spectra(hdf, sname, meta, max_npix=10000, chk_meta_only=False,
                    refs=None, verbose=False, badf=None, set_idkey=None,
-                   grab_conti=False, **kwargs):
+                   grab_conti=False, layout='padded', wave_encoding=False, codec='gzip',
+                   chunk_rows=None, contiguous=False, workers=None, **kwargs):
     """ Ingest the spectra
     Parameters
     ----------
@@ -428,6 +507,26 @@ def ingest_spectra(hdf, sname, meta, max_npix=10000, chk_meta_only=False,
       Grab continua.  They should exist but do not have to
     set_idkey : str, optional
       Only required if you are not performing the full script
+    layout : str, optional
+      Storage of the spectra
+        'padded' -- One row per spectrum in the spec dataset, padded to max_npix
+        'flat' -- Pixels of all the spectra concatenated in the spec_flat dataset,
+          with spectrum i in spec_offsets[i]:spec_offsets[i+1]
+    wave_encoding : bool, optional
+      Store linear and log-linear wavelength grids as a solution (wave_solution)
+      instead of a wave array.  Other grids are stored in wave_explicit
+    codec : str, optional
+      Compression of the spectra;  see build.utils.codec_kwargs
+    chunk_rows : int, optional
+      Number of spectra per HDF5 chunk (padded layout);  the flat layout
+      uses chunk_rows*max_npix pixels.  Default is to let h5py guess
+    contiguous : bool, optional
+      Write the spec dataset contiguous and uncompressed (padded layout only;
+      codec and chunk_rows are ignored), so that it may be memory mapped
+    workers : int, optional
+      Number of processes reading the FITS files;  the spectra are
+      written in order by a separate thread.  Default is to read them
+      one at a time
 
     Returns
     -------
@@ -444,58 +543,149 @@ def ingest_spectra(hdf, sname, meta, max_npix=10000, chk_meta_only=False,
            (str('flux'), 'float32', (max_npix)),
            (str('sig'),  'float32', (max_npix))]
     dkeys = ['wave','flux','sig']
+    # Compression and chunking
+    if contiguous:
+        if layout != 'padded':
+            raise IOError("Contiguous storage requires the padded layout")
+        codec = None
+    ckwargs = spbu.codec_kwargs(codec)
+    if chunk_rows is None:
+        spec_chunks, pix_chunks = True, (2**16,)
+    else:
+        spec_chunks, pix_chunks = (int(chunk_rows),), (int(chunk_rows)*max_npix,)
+    if wave_encoding:
+        dtypes, dkeys = dtypes[1:], dkeys[1:]
+        wave_soln = np.zeros(nspec, dtype=wave_solution_dtype)
+        wave_set = hdf[sname].create_dataset('wave_explicit', (0,), dtype='float64', chunks=pix_chunks,
+                                             maxshape=(None,), **ckwargs)
     if grab_conti:
         dtypes += [(str('co'),   'float32', (max_npix))]
         dkeys += ['co']
     data = np.ma.empty((1,), dtype=dtypes)
     # Init
-    spec_set = hdf[sname].create_dataset('spec', data=data, chunks=True,
-                                         maxshape=(None,), compression='gzip')
-    spec_set.resize((nspec,))
+    if contiguous:
+        spec_set = hdf[sname].create_dataset('spec', (nspec,), dtype=data.dtype)
+    elif layout == 'padded':
+        spec_set = hdf[sname].create_dataset('spec', data=data, chunks=spec_chunks,
+                                             maxshape=(None,), **ckwargs)
+        spec_set.resize((nspec,))
+    elif layout == 'flat':
+        pix_dtypes = [(dtype[0], dtype[1]) for dtype in dtypes]
+        spec_set = hdf[sname].create_dataset('spec_flat', (0,), dtype=pix_dtypes, chunks=pix_chunks,
+                                             maxshape=(None,), **ckwargs)
+        offsets = [0]
+    else:
+        raise IOError("Bad layout for the spectra: {:s}".format(layout))
+    grp.attrs['SPEC_LAYOUT'] = str(layout)
     wvminlist = []
     wvmaxlist = []
     npixlist = []
-    # Loop
-    for jj,member in enumerate(meta['SPEC_FILE']):
-        # Extract
-        f = member
-        # Parse name
-        fname = f.split('/')[-1]
-        if verbose:
-            print(fname)
-        # Read
-        if badf is not None:
-            for ibadf in badf:
-                if ibadf in f:
-                    spec = dumb_spec()
-                else:
-                    try:
-                        spec = lsio.readspec(f)#, **kwargs)
-                    except ValueError:  # Probably a continuum problem
-                        pdb.set_trace()
+    # Rows written per block
+    if chunk_rows is None:
+        nblock = 100
+    else:
+        nblock = int(chunk_rows)
+    if layout != 'flat':
+        block = np.zeros(nblock, dtype=data.dtype)
+
+    def write_block(i0, nrow, pending):
+        # Write rows i0:i0+nrow of the spectra
+        if layout == 'flat':
+            pix = np.concatenate(pending)
+            spec_set.resize((offsets[-1]+pix.size,))
+            spec_set[offsets[-1]:offsets[-1]+pix.size] = pix
+            for item in pending:
+                offsets.append(offsets[-1]+item.size)
         else:
-            spec = lsio.readspec(f)#, **kwargs)
-        # npix
-        head = spec.header
-        npix = spec.npix
-        if npix > max_npix:
-            raise ValueError("Not enough pixels in the data... ({:d} vs {:d})".format(
-                    npix, max_npix))
-        # Some fiddling about
-        for key in dkeys:
-            data[key] = 0.  # Important to init (for compression too)
-        data['flux'][0][:npix] = spec.flux.value
-        data['sig'][0][:npix] = spec.sig.value
-        data['wave'][0][:npix] = spec.wavelength.value
-        if grab_conti:
-            if spec.co_is_set:
-                data['co'][0][:npix] = spec.co.value
-        # Meta
-        wvminlist.append(np.min(data['wave'][0][:npix]))
-        wvmaxlist.append(np.max(data['wave'][0][:npix]))
-        npixlist.append(npix)
-        # Set
-        spec_set[jj] = data
+            spec_set[i0:i0+nrow] = block[:nrow]
+
+    def write_spectra(spectra):
+        # Loop
+        i0, pending = 0, []
+        for jj, (wave, flux, sig, co) in enumerate(spectra):
+            # npix
+            npix = flux.size
+            if (npix > max_npix) and (layout == 'padded'):
+                raise ValueError("Not enough pixels in the data... ({:d} vs {:d})".format(
+                        npix, max_npix))
+            # Meta
+            wvminlist.append(np.min(wave))
+            wvmaxlist.append(np.max(wave))
+            npixlist.append(npix)
+            # Wavelengths
+            if wave_encoding:
+                wtype, wv0, dwv = fit_wave_solution(wave)
+                iw = wave_set.size
+                wave_soln[jj] = (wtype, wv0, dwv, npix, iw)
+                if wtype == WAVE_EXPLICIT:
+                    wave_set.resize((iw+npix,))
+                    wave_set[iw:iw+npix] = wave
+            # Flat
+            if layout == 'flat':
+                pix = np.zeros(npix, dtype=pix_dtypes)
+                pix['flux'] = flux
+                pix['sig'] = sig
+                if not wave_encoding:
+                    pix['wave'] = wave
+                if co is not None:
+                    pix['co'] = co
+                pending.append(pix)
+            else:
+                row = block[jj-i0]
+                for key in dkeys:
+                    row[key] = 0.  # Important to init (for compression too)
+                row['flux'][:npix] = flux
+                row['sig'][:npix] = sig
+                if not wave_encoding:
+                    row['wave'][:npix] = wave
+                if co is not None:
+                    row['co'][:npix] = co
+            # Set
+            if jj+1-i0 == nblock:
+                write_block(i0, nblock, pending)
+                i0, pending = jj+1, []
+        if len(npixlist) > i0:
+            write_block(i0, len(npixlist)-i0, pending)
+
+    # Read and write
+    spectra = read_spectra(meta['SPEC_FILE'], badf=badf, grab_conti=grab_conti,
+                           workers=workers, verbose=verbose)
+    if (workers is None) or (workers <= 1):
+        write_spectra(spectra)
+    else:
+        import threading
+        try:
+            import queue
+        except ImportError:  # For Python 2
+            import Queue as queue
+        # Writer thread;  the bounded queue holds back the readers
+        spec_queue = queue.Queue(maxsize=2*nblock)
+        errors = []
+
+        def writer():
+            try:
+                write_spectra(iter(spec_queue.get, None))
+            except Exception as e:
+                errors.append(e)
+                for item in iter(spec_queue.get, None):  # Drain
+                    pass
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for item in spectra:
+                if len(errors) > 0:  # The writer failed
+                    break
+                spec_queue.put(item)
+        finally:
+            spectra.close()
+            spec_queue.put(None)
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+    if layout == 'flat':
+        hdf[sname]['spec_offsets'] = np.array(offsets, dtype=np.int64)
+    if wave_encoding:
+        hdf[sname]['wave_solution'] = wave_soln
 
     # Add columns
     meta.add_column(Column(npixlist, name='NPIX'))
@@ -510,6 +700,8 @@ def ingest_spectra(hdf, sname, meta, max_npix=10000, chk_meta_only=False,
     else:
         pdb.set_trace()
         raise ValueError("meta file failed")
+    # Column indexes
+    spbu.write_column_indexes(grp.create_group('index'), meta, [spbu.sv_idkey]+META_INDEX_KEYS)
     # References
     if refs is not None:
         jrefs = ltu.jsonify(refs)
@@ -518,6 +710,96 @@ def ingest_spectra(hdf, sname, meta, max_npix=10000, chk_meta_only=False,
     return
 
 
+def grab_ztbl(iztbl):
+    """ Parse the redshift table input to mk_db() or append_group()
+
+    Parameters
+    ----------
+    iztbl : Table or str
+      If str, it must be 'igmspec'
+
+    Returns
+    -------
+    ztbl : Table
+
+    """
+    if isinstance(iztbl, basestring):
+        if iztbl == 'igmspec':
+            from specdb.specdb import IgmSpec
+            igmsp = IgmSpec()
+            ztbl = Table(igmsp.idb.hdf['quasars'].value)
+        else:
+            raise IOError("Bad value for ztbl")
+    elif isinstance(iztbl, Table):
+        ztbl = iztbl
+    else:
+        raise IOError("Bad type for ztbl")
+    return ztbl
+
+
+def ingest_branch(hdf, branch, ztbl, maindb, tkeys, gdict, id_key='PRIV_ID', **kwargs):
+    """ Add one branch of the tree to the DB as a new group:
+    its meta data, its spectra and the IDs of its sources
+
+    Parameters
+    ----------
+    hdf : h5py.File
+      Must be writeable
+    branch : str
+      Path to the branch;  its name is the group name
+    ztbl : Table
+    maindb : Table
+      Main catalog
+    tkeys : list
+      List of main keys for the catalog
+    gdict : dict
+      Group dict;  updated in place
+    id_key : str, optional
+
+    Returns
+    -------
+    maindb : Table
+      Updated catalog table
+
+    """
+    print('Working on branch: {:s}'.format(branch))
+    # Files
+    fits_files, out_tup = grab_files(branch)
+    meta_file, mtbl_file, ssa_file = out_tup
+
+    # Meta
+    maxpix, phead, mdict, stype = 10000, None, None, 'QSO'
+    if meta_file is not None:
+        # Load
+        meta_dict = ltu.loadjson(meta_file)
+        # Maxpix
+        if 'maxpix' in meta_dict.keys():
+            maxpix = meta_dict['maxpix']
+        # STYPE
+        if 'stype' in meta_dict.keys():
+            stype = meta_dict['stype']
+        # Parse header
+        if 'parse_head' in meta_dict.keys():
+            phead = meta_dict['parse_head']
+        if 'meta_dict' in meta_dict.keys():
+            mdict = meta_dict['meta_dict']
+    full_meta = mk_meta(fits_files, ztbl, mtbl_file=mtbl_file,
+                        parse_head=phead, mdict=mdict, **kwargs)
+    # Update group dict
+    group_name = os.path.basename(os.path.normpath(branch))
+    flag_g = spbu.add_to_group_dict(group_name, gdict)
+    # IDs
+    maindb = add_ids(maindb, full_meta, flag_g, tkeys, id_key, first=(flag_g==1))
+    # Ingest
+    ingest_spectra(hdf, group_name, full_meta, max_npix=maxpix, **kwargs)
+    # SSA
+    if ssa_file is not None:
+        user_ssa = ltu.loadjson(ssa_file)
+        ssa_dict = default_fields(user_ssa['Title'], flux=user_ssa['flux'], fxcalib=user_ssa['fxcalib'])
+        hdf[group_name]['meta'].attrs['SSA'] = json.dumps(ltu.jsonify(ssa_dict))
+    return maindb
+
+
 def mk_db(dbname, tree, outfil, iztbl, version='v00', id_key='PRIV_ID',
           publisher='Unknown', **kwargs):
     """ Generate the DB
@@ -544,15 +826,7 @@ def mk_db(dbname, tree, outfil, iztbl, version='v00', id_key='PRIV_ID',
     from specdb import defs
 
     # ztbl
-    if isinstance(iztbl, basestring):
-        if iztbl == 'igmspec':
-            from specdb.specdb import IgmSpec
-            igmsp = IgmSpec()
-            ztbl = Table(igmsp.idb.hdf['quasars'].value)
-    elif isinstance(iztbl, Table):
-        ztbl = iztbl
-    else:
-        raise IOError("Bad type for ztbl")
+    ztbl = grab_ztbl(iztbl)
 
     # Find the branches
     branches = glob.glob(tree+'/*')
@@ -572,41 +846,7 @@ def mk_db(dbname, tree, outfil, iztbl, version='v00', id_key='PRIV_ID',
         # Skip files
         if not os.path.isdir(branch):
             continue
-        print('Working on branch: {:s}'.format(branch))
-        # Files
-        fits_files, out_tup = grab_files(branch)
-        meta_file, mtbl_file, ssa_file = out_tup
-
-        # Meta
-        maxpix, phead, mdict, stype = 10000, None, None, 'QSO'
-        if meta_file is not None:
-            # Load
-            meta_dict = ltu.loadjson(meta_file)
-            # Maxpix
-            if 'maxpix' in meta_dict.keys():
-                maxpix = meta_dict['maxpix']
-            # STYPE
-            if 'stype' in meta_dict.keys():
-                stype = meta_dict['stype']
-            # Parse header
-            if 'parse_head' in meta_dict.keys():
-                phead = meta_dict['parse_head']
-            if 'meta_dict' in meta_dict.keys():
-                mdict = meta_dict['meta_dict']
-        full_meta = mk_meta(fits_files, ztbl, mtbl_file=mtbl_file,
-                            parse_head=phead, mdict=mdict, **kwargs)
-        # Update group dict
-        group_name = branch.split('/')[-1]
-        flag_g = spbu.add_to_group_dict(group_name, gdict)
-        # IDs
-        maindb = add_ids(maindb, full_meta, flag_g, tkeys, 'PRIV_ID', first=(flag_g==1))
-        # Ingest
-        ingest_spectra(hdf, group_name, full_meta, max_npix=maxpix, **kwargs)
-        # SSA
-        if ssa_file is not None:
-            user_ssa = ltu.loadjson(ssa_file)
-            ssa_dict = default_fields(user_ssa['Title'], flux=user_ssa['flux'], fxcalib=user_ssa['fxcalib'])
-            hdf[group_name]['meta'].attrs['SSA'] = json.dumps(ltu.jsonify(ssa_dict))
+        maindb = ingest_branch(hdf, branch, ztbl, maindb, tkeys, gdict, id_key=id_key, **kwargs)
 
     # Check stacking
     if not spbu.chk_vstack(hdf):
@@ -620,3 +860,69 @@ def mk_db(dbname, tree, outfil, iztbl, version='v00', id_key='PRIV_ID',
     print("Wrote {:s} DB file".format(outfil))
 
 
+def append_group(branch, outfil, iztbl, version=None, id_key='PRIV_ID', **kwargs):
+    """ Add one branch of FITS files to an existing DB as a new group,
+    without rebuilding the DB
+
+    Only the spectra of the new branch are ingested;  the catalog,
+    GROUP_DICT and the indexes are rewritten in place
+
+    Parameters
+    ----------
+    branch : str
+      Path to the branch;  its name is the group name
+    outfil : str
+      DB file generated by mk_db()
+    iztbl : Table or str
+      See mk_db()
+    version : str, optional
+      Version code;  default is to keep that of the DB
+    id_key : str, optional
+      Must be the ID key of the DB
+
+    Returns
+    -------
+
+    """
+    # ztbl
+    ztbl = grab_ztbl(iztbl)
+    if not os.path.isdir(branch):
+        raise IOError("Branch {:s} is not a directory".format(branch))
+    # HDF5 file
+    hdf = h5py.File(outfil,'r+')
+    attrs = dict(hdf['catalog'].attrs.items())
+    gdict = json.loads(hdf_decode(attrs.pop('GROUP_DICT')))
+    group_name = os.path.basename(os.path.normpath(branch))
+    if group_name in gdict.keys():
+        hdf.close()
+        raise IOError("Group {:s} is already in the DB".format(group_name))
+
+    # Main DB Table
+    maindb = hdf_decode(hdf['catalog'][()], itype='Table')
+    if id_key not in maindb.keys():
+        hdf.close()
+        raise IOError("ID key {:s} is not in the catalog".format(id_key))
+    set_sv_idkey(id_key)
+    tkeys = list(maindb.keys())
+
+    # Ingest
+    maindb = ingest_branch(hdf, branch, ztbl, maindb, tkeys, gdict, id_key=id_key, **kwargs)
+
+    # Check stacking
+    if not spbu.chk_vstack(hdf):
+        hdf.close()
+        raise ValueError("Meta data will not stack using specdb.utils.clean_vstack")
+
+    # Write, keeping the attributes of the catalog
+    dbname = hdf_decode(attrs.pop('NAME'))
+    zpri = [hdf_decode(z) for z in attrs.pop('Z_PRIORITY')]
+    if version is None:
+        version = hdf_decode(attrs['VERSION'])
+    epoch = attrs.pop('EPOCH')
+    spaceframe = hdf_decode(attrs.pop('SpaceFrame'))
+    for key in ['VERSION', 'EQUINOX', 'CREATION_DATE']:  # Set by write_hdf
+        attrs.pop(key)
+    del hdf['catalog']
+    write_hdf(hdf, dbname, maindb, zpri, gdict, version, epoch=epoch,
+              spaceframe=spaceframe, **attrs)
+    print("Appended group {:s} to {:s}".format(group_name, outfil))
@@ -57,6 +57,56 @@ def test_ingest():
     assert isinstance(tmp['test/spec'].value, np.ndarray)
 
 
+def test_ingest_flat(tmpdir):
+    from specdb.group_utils import FlatSpec
+    ztbl = Table.read(os.path.join(os.path.dirname(__file__), 'files', 'ztbl_E.fits'))
+    data_dir = os.path.join(os.path.dirname(__file__), 'files')
+    ffiles,_ = pbuild.grab_files(data_dir)
+    meta = pbuild.mk_meta(ffiles, ztbl, fname=True, skip_badz=True, mdict=dict(INSTR='HIRES'))
+    maindb, tkeys = spbu.start_maindb('TEST_ID')
+    maindb = pbuild.add_ids(maindb, meta, 1, tkeys, 'TEST_ID', first=True)
+    tmp_file = str(tmpdir.join('tmp_flat.hdf5'))
+    #
+    hdf = h5py.File(tmp_file,'w')
+    pbuild.ingest_spectra(hdf, 'test', meta, layout='flat')
+    hdf.close()
+    # Read
+    tmp = h5py.File(tmp_file,'r')
+    assert tmp['test'].attrs['SPEC_LAYOUT'] == 'flat'
+    npix = tmp['test/meta']['NPIX']
+    assert tmp['test/spec_flat'].size == np.sum(npix)
+    flat = FlatSpec(tmp['test'])
+    assert np.array_equal(flat.npix, npix)
+    data = flat[0:2]
+    assert data['flux'].shape == (2, np.max(npix))
+    assert np.all(data['wave'][0][npix[0]:] == 0.)
+    tmp.close()
+
+
+def test_ingest_workers(tmpdir):
+    ztbl = Table.read(os.path.join(os.path.dirname(__file__), 'files', 'ztbl_E.fits'))
+    data_dir = os.path.join(os.path.dirname(__file__), 'files')
+    ffiles,_ = pbuild.grab_files(data_dir)
+    meta = pbuild.mk_meta(ffiles, ztbl, fname=True, skip_badz=True, mdict=dict(INSTR='HIRES'))
+    maindb, tkeys = spbu.start_maindb('TEST_ID')
+    maindb = pbuild.add_ids(maindb, meta, 1, tkeys, 'TEST_ID', first=True)
+    tmp_file = str(tmpdir.join('tmp_workers.hdf5'))
+    # One at a time vs. a pool of readers, in blocks of 1 row
+    spec = []
+    for workers in [None, 2]:
+        hdf = h5py.File(tmp_file,'w')
+        pbuild.ingest_spectra(hdf, 'test', meta.copy(), workers=workers, chunk_rows=1)
+        spec.append(hdf['test/spec'][()])
+        hdf.close()
+    assert np.array_equal(spec[0], spec[1])
+    assert np.any(spec[0]['flux'][0] != spec[0]['flux'][1])
+    # Fail in the writer
+    hdf = h5py.File(tmp_file,'w')
+    with pytest.raises(ValueError):
+        pbuild.ingest_spectra(hdf, 'test', meta.copy(), workers=2, max_npix=10)
+    hdf.close()
+
+
 def test_mkdb():
     import specdb
     # Redshift table
@@ -69,3 +119,64 @@ def test_mkdb():
     hdf = h5py.File(data_path('tst_db.hdf5'),'r')
     ssadict = json.loads(hdf['COS/meta'].attrs['SSA'])
     assert ssadict['FluxUcd'] == 'phot.fluDens;em.wl'
+
+
+def test_append_group(tmpdir):
+    import specdb
+    import shutil
+    from specdb.spectra_index import SpectraIndex
+    from specdb.group_index import GroupIndex
+    ztbl = Table.read(specdb.__path__[0]+'/data/test_privateDB/testDB_ztbl.fits')
+    tree = specdb.__path__[0]+'/data/test_privateDB'
+    # DB without LRIS
+    tmp_tree = str(tmpdir.join('tree'))
+    db_file = str(tmpdir.join('tmp_append.hdf5'))
+    for branch in ['COS', 'ESI']:
+        shutil.copytree(tree+'/'+branch, tmp_tree+'/'+branch)
+    pbuild.mk_db('tst_db', tmp_tree, db_file, ztbl, fname=True)
+    # Append
+    pbuild.append_group(tree+'/LRIS', db_file, ztbl, fname=True)
+    hdf = h5py.File(db_file,'r')
+    gdict = json.loads(hdf['catalog'].attrs['GROUP_DICT'])
+    assert gdict['LRIS'] == 4
+    assert np.sum((hdf['catalog']['flag_group'] & 4) > 0) == 1
+    assert hdf['catalog'].attrs['Publisher'] == 'Unknown'
+    assert 'spec' in hdf['LRIS'].keys()
+    # Indexes
+    sindex = SpectraIndex.from_hdf(hdf)
+    assert sindex.groups == ['COS', 'ESI', 'LRIS']
+    assert sindex.row.size == 6
+    gindex = GroupIndex.from_hdf(hdf)
+    assert np.sum(gindex.select(['LRIS'])) == 1
+    hdf.close()
+    # Fail (already in the DB)
+    with pytest.raises(IOError):
+        pbuild.append_group(tree+'/LRIS', db_file, ztbl, fname=True)
+
+
+def test_memory_budget(tmpdir):
+    import specdb
+    from astropy import units as u
+    from specdb.specdb import SpecDB
+    ztbl = Table.read(specdb.__path__[0]+'/data/test_privateDB/testDB_ztbl.fits')
+    tree = specdb.__path__[0]+'/data/test_privateDB'
+    db_file = str(tmpdir.join('tmp_budget.hdf5'))
+    pbuild.mk_db('tst_db', tree, db_file, ztbl, fname=True)
+    # Budget of 2.5 Mb;  staging the two COS spectra takes about 2.9 Mb
+    sdb = SpecDB(db_file=db_file, maximum_ram=2.5e-3)
+    meta = sdb.meta_from_position((148.1674, 51.8806), 1*u.deg, groups=['COS'])
+    assert len(meta) == 2
+    with pytest.raises(IOError):
+        sdb.spectra_from_meta(meta)
+    # In batches
+    nspec = 0
+    for sub_meta, data in sdb.iter_spectra(meta, batch_size=1):
+        nspec += len(sub_meta)
+        del data
+    assert nspec == 2
+    sdb.hdf.close()
+    # Within the budget
+    sdb = SpecDB(db_file=db_file, maximum_ram=10e-3)
+    spec = sdb.spectra_from_meta(meta)
+    assert spec.nspec == 2
+    sdb.hdf.close()
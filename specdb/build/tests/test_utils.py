@@ -75,8 +75,44 @@ def test_get_newids():
     meta['RA_GROUP'] = [1., 4., 6., 6., 6.]
     meta['DEC_GROUP'] = [2., 5, 7., 7., 7.0002]  # Last entry adds a 'pair'
     IDs = spbu.get_new_ids(maindb, meta, 'ID_KEY', close_pairs=True)
+    assert np.array_equal(IDs, [0, 3, 5, 5, 5])
 
 
+def test_friends_of_friends():
+    from astropy import units as u
+    # Chain of 3 linked by 1.5", plus an isolated source first
+    coords = SkyCoord(ra=[10., 1., 1., 1.], dec=[10., 2., 2.0004, 2.0008], unit='deg')
+    ngroup, group, nearest = spbu.friends_of_friends(coords, 2*u.arcsec)
+    assert ngroup == 2
+    assert np.array_equal(group, [0, 1, 1, 1])
+    assert np.isinf(nearest[0])
+    np.testing.assert_allclose(nearest[1:].to('arcsec').value, 1.44, rtol=1e-3)
+    ngroup, group, nearest = spbu.friends_of_friends(coords, 1*u.arcsec, max_sep=2*u.arcsec)
+    assert np.array_equal(group, [0, 1, 2, 3])
+    np.testing.assert_allclose(nearest[1:].to('arcsec').value, 1.44, rtol=1e-3)
 
 
 
+
+
+
+def test_add_to_flag():
+    assert spbu.add_to_flag(3, 4) == 7
+    assert spbu.add_to_flag(5, 4) == 5
+    flags = spbu.add_to_flag(np.array([0, 3, 4, 12]), 4)
+    assert np.array_equal(flags, [4, 7, 4, 12])
+
+
+def test_codec_kwargs(tmpdir):
+    import h5py
+    assert spbu.codec_kwargs(None) == {}
+    assert spbu.codec_kwargs('gzip-shuffle') == dict(compression='gzip', shuffle=True)
+    with pytest.raises(IOError):
+        spbu.codec_kwargs('bad')
+    # Round trip
+    hdf = h5py.File(str(tmpdir.join('tmp_codec.hdf5')), 'w')
+    data = np.arange(1000.)
+    for codec in ['gzip', 'lzf', 'lzf-shuffle']:
+        hdf.create_dataset(codec, data=data, chunks=(100,), **spbu.codec_kwargs(codec))
+        assert np.array_equal(hdf[codec][()], data)
+    hdf.close()
@@ -16,6 +16,10 @@ from linetools import utils as ltu
 
 from specdb import defs
 from specdb.cat_utils import match_ids
+from specdb.sky_index import SkyIndex, INDEX_GROUP
+from specdb.column_index import ColumnIndex, CATALOG_INDEX_KEYS
+from specdb.spectra_index import SpectraIndex
+from specdb.group_index import GroupIndex
 from specdb.utils import clean_vstack
 
 try:
@@ -87,13 +91,9 @@ def add_to_flag(cur_flag, add_flag):
 
     """
     if isinstance(cur_flag, numbers.Integral):
-        if (cur_flag % add_flag) < (add_flag//2):
-            cur_flag += add_flag
-        return cur_flag
+        return cur_flag | add_flag
     else:  # Array
-        mods = cur_flag % add_flag
-        upd = mods < (add_flag//2)
-        cur_flag[upd] += add_flag
+        cur_flag |= add_flag
         return cur_flag
 
 
@@ -297,6 +297,43 @@ def clean_table_for_hdf(tbl):
             tbl.remove_column(key)
             tbl[key] = tmp
 
+def codec_kwargs(codec):
+    """ Keywords for h5py create_dataset for a compression codec
+
+    Parameters
+    ----------
+    codec : str or None
+      None or 'none' -- No compression
+      'gzip' -- gzip (deflate)
+      'gzip-shuffle' -- gzip with the byte shuffle filter
+      'lzf' -- LZF;  fast, bundled with h5py
+      'lzf-shuffle' -- LZF with the byte shuffle filter
+      'blosc' -- Blosc (lz4) with byte shuffle;  requires hdf5plugin
+      'zstd' -- Zstandard;  requires hdf5plugin
+
+    Returns
+    -------
+    ckwargs : dict
+    """
+    if codec in [None, 'none']:
+        return {}
+    elif codec in ['gzip', 'lzf']:
+        return dict(compression=codec)
+    elif codec in ['gzip-shuffle', 'lzf-shuffle']:
+        return dict(compression=codec.split('-')[0], shuffle=True)
+    elif codec in ['blosc', 'zstd']:
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("The {:s} codec requires hdf5plugin.  Install it or choose another codec".format(codec))
+        if codec == 'blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        else:
+            return dict(hdf5plugin.Zstd())
+    else:
+        raise IOError("Unknown compression codec: {:s}".format(codec))
+
+
 def get_new_ids(maindb, newdb, idkey, chk=True, mtch_toler=None, pair_sep=0.5*u.arcsec,
                 close_pairs=False):
     """ Generate new CAT_IDs for an input DB
@@ -358,31 +395,27 @@ def get_new_ids(maindb, newdb, idkey, chk=True, mtch_toler=None, pair_sep=0.5*u.
         IDs[new_idx] = newID + 1
     elif nnew > 1: # Deal with duplicates
         sub_c_new = c_new[new]
-        dup_idx, dup_d2d, _ = match_coordinates_sky(sub_c_new, sub_c_new, nthneighbor=2)
+        # Groups of new sources within mtch_toler, and the separation to the nearest other one
+        ngroup, group, nearest = friends_of_friends(sub_c_new, mtch_toler,
+                                                    max_sep=max(pair_sep, mtch_toler))
         if close_pairs:
-            dups = dup_d2d < pair_sep
+            dups = nearest < pair_sep
         else:
-            dups = dup_d2d < mtch_toler
+            dups = nearest < mtch_toler
         ndups = np.sum(dups)
         # Not duplicates
         IDs[new_idx[~dups]] = newID + 1 + np.arange(np.sum(~dups))
-        # Duplicates
+        # Duplicates;  one ID per group holding a duplicate, in order of its
+        #  first duplicate, given to every source of the group
         if ndups > 0:
             newID = np.max(IDs)
             warnings.warn("We found {:d} duplicates (e.g. multiple spectra). Hope this was expected".format(ndups//2))
-            # Cut down to unique and restrict to new ones (there are at least 2 duplicates per match)
             dup_idx = np.where(dups)[0]
-            dup_filled = np.array([False]*len(sub_c_new))
-            for idup in dup_idx: # Ugly loop..
-                if dup_filled[idup]:  # Already filled as a duplicate
-                    continue
-                dcoord = sub_c_new[idup]
-                sep = dcoord.separation(sub_c_new)
-                isep = np.where(sep < mtch_toler)[0]
-                # ID
-                newID += 1
-                IDs[new_idx[isep]] = newID
-                dup_filled[isep] = True  # Avoids the other dup(s)
+            dup_groups, first = np.unique(group[dup_idx], return_index=True)
+            gID = np.full(ngroup, -1, dtype=int)
+            gID[dup_groups[np.argsort(dup_idx[first])]] = newID + 1 + np.arange(dup_groups.size)
+            members = np.where(gID[group] >= 0)[0]
+            IDs[new_idx[members]] = gID[group[members]]
     if chk:
         print("The following sources were previously in the DB")
         print(newdb[~new])
@@ -397,6 +430,50 @@ def get_new_ids(maindb, newdb, idkey, chk=True, mtch_toler=None, pair_sep=0.5*u.
     return IDs
 
 
+def friends_of_friends(coords, link, max_sep=None):
+    """ Group a set of sources by friends-of-friends:  sources closer
+    than the linking length are in the same group, transitively
+
+    One search_around_sky pass plus the connected components of the
+    resulting graph, i.e. O(N log N)
+
+    Parameters
+    ----------
+    coords : SkyCoord
+    link : Angle
+      Linking length
+    max_sep : Angle, optional
+      Search radius for the nearest neighbor;  defaults to link
+
+    Returns
+    -------
+    ngroup : int
+    group : int ndarray
+      Group of each source;  groups are numbered in order of their first member
+    nearest : Angle
+      Separation to the nearest other source;  inf if none is within max_sep
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    if max_sep is None:
+        max_sep = link
+    nsrc = len(coords)
+    idx1, idx2, d2d, _ = coords.search_around_sky(coords, max(link, max_sep))
+    other = idx1 != idx2
+    keep = other & (d2d < link)
+    graph = coo_matrix((np.ones(np.sum(keep), dtype=np.int8), (idx1[keep], idx2[keep])),
+                       shape=(nsrc, nsrc))
+    ngroup, labels = connected_components(graph, directed=False)
+    # Renumber by first member
+    _, first = np.unique(labels, return_index=True)
+    order = np.zeros(ngroup, dtype=int)
+    order[np.argsort(first)] = np.arange(ngroup)
+    # Nearest neighbor
+    nearest = np.full(nsrc, np.inf)
+    np.minimum.at(nearest, idx1[other], d2d[other].to('deg').value)
+    return ngroup, order[labels], nearest*u.deg
+
+
 def init_data(npix, include_co=False):
     """ Generate an empty masked array for a spectral dataset
 
@@ -642,6 +719,39 @@ def start_maindb(idkey, **kwargs):
     return maindb, tkeys
 
 
+def write_column_indexes(grp, tbl, keys):
+    """ Write sorted indexes of a set of columns to the DB
+
+    Parameters
+    ----------
+    grp : h5py.Group
+    tbl : Table
+    keys : list
+      Columns not in the Table are skipped
+
+    """
+    for key in keys:
+        if key in tbl.keys():
+            ColumnIndex.from_column(tbl[key].data).write(grp, key)
+
+
+def write_spectra_index(hdf, gdict, idkey):
+    """ Write the index of the spectra of each source to the DB
+
+    Parameters
+    ----------
+    hdf : h5py.File
+    gdict : dict
+      Group dict;  the groups are indexed in the order of their flags
+    idkey : str
+
+    """
+    groups = [group for group in sorted(gdict, key=gdict.get)
+              if (group in hdf.keys()) and ('meta' in hdf[group].keys())]
+    group_ids = [hdf[group]['meta'][idkey] for group in groups]
+    SpectraIndex.from_ids(group_ids, groups).write(hdf)
+
+
 def write_hdf(hdf, dbname, maindb, zpri, gdict, version, epoch=2000.,
               spaceframe='ICRS', **kwargs):
     """
@@ -676,6 +786,16 @@ def write_hdf(hdf, dbname, maindb, zpri, gdict, version, epoch=2000.,
     # kwargs
     for key in kwargs:
         hdf['catalog'].attrs[str.encode(key)] = kwargs[key]
+    # Sky index
+    sky_index = SkyIndex.from_radec(maindb['RA'].data, maindb['DEC'].data)
+    sky_index.write(hdf)
+    # Column indexes
+    idkeys = [key for key in maindb.keys() if 'ID' in key]
+    write_column_indexes(hdf.require_group(INDEX_GROUP+'/columns'), maindb, idkeys+CATALOG_INDEX_KEYS)
+    # Spectra index
+    write_spectra_index(hdf, gdict, sv_idkey)
+    # Group membership
+    GroupIndex.from_flags(maindb['flag_group'].data, gdict).write(hdf)
     # Close
     hdf.close()
 
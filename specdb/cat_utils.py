@@ -60,19 +60,64 @@ def flags_to_groups(flags, group_dict):
     groups : str ndarray
       Array of expanded list of groups corresponding to input flags
     """
-    # Ugly for loops appear necessary
-    group_list = [[] for ii in range(len(flags))]
-    for key,value in group_dict.items():
-        in_flags = np.where(flags & value)[0]
-        for ii in in_flags:
-            group_list[ii].append(key)
-    # More
-    for ii,ilist in enumerate(group_list):
-        group_list[ii] = ','.join(ilist)
-    # Finally
-    garray = np.array(group_list)
-    # Return
-    return garray
+    # Decode each distinct flag value once
+    codes, categories = flags_to_categories(flags, group_dict)
+    return categories[codes]
+
+
+def flags_to_categories(flags, group_dict):
+    """ Convert flag values to categorical codes, one category per
+    distinct combination of groups
+
+    Parameters
+    ----------
+    flags : list or ndarray
+      BITWISE flags
+    group_dict : dict
+      dict that converts the BITWISE flags to group names
+
+    Returns
+    -------
+    codes : int ndarray
+      Aligned with flags;  index into categories
+    categories : str ndarray
+      Group names (comma separated) of each category
+    """
+    flags = np.asarray(flags, dtype=int)
+    if (flags.size > 0) and (flags.min() >= 0) and (flags.max() < 2**20):
+        # Lookup table over the flag values;  avoids a sort
+        present = np.zeros(flags.max()+1, dtype=bool)
+        present[flags] = True
+        uflags = np.flatnonzero(present)
+        lut = np.cumsum(present) - 1
+        codes = lut[flags]
+    else:
+        uflags, codes = np.unique(flags, return_inverse=True)
+    categories = np.array([','.join(flag_to_groups(uflag, group_dict)) for uflag in uflags])
+    return codes, categories
+
+
+def flags_to_membership(flags, group_dict):
+    """ Convert flag values to a boolean membership matrix
+
+    Parameters
+    ----------
+    flags : list or ndarray
+      BITWISE flags
+    group_dict : dict
+      dict that converts the BITWISE flags to group names
+
+    Returns
+    -------
+    members : bool ndarray (nflag, ngroup)
+      True if the source is in the group
+    groups : list
+      Group names, aligned with the columns of members
+    """
+    groups = list(group_dict.keys())
+    gflags = np.array([group_dict[group] for group in groups], dtype=int)
+    members = (np.asarray(flags, dtype=int)[:, None] & gflags[None, :]) != 0
+    return members, groups
 
 
 def flag_to_groups(flag, group_dict):
@@ -91,8 +136,8 @@ def flag_to_groups(flag, group_dict):
       Expanded list of groups corresponding to input flag
     """
     groups = []
-    for key,sflag in groups.items():
-        if flag % (2*sflag) >= sflag:
+    for key,sflag in group_dict.items():
+        if flag & sflag:
             groups.append(key)
     # Return
     return groups
@@ -0,0 +1,276 @@
+""" Module for sorted indexes of the columns of the catalog and meta tables
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import pdb
+
+# Columns indexed in the DB file at build time (plus the ID key)
+#  catalog_index/columns/<key> and <group>/index/<key>
+CATALOG_INDEX_KEYS = ['zem']
+META_INDEX_KEYS = ['GROUP_ID', 'INSTR', 'R', 'WV_MIN', 'WV_MAX']
+
+
+class ColumnIndex(object):
+    """ A sorted index of one column of a table
+
+    Equality, membership and range lookups are binary searches
+    on the sorted values.
+
+    Parameters
+    ----------
+    order : int ndarray
+      Rows of the table that sort the column (stable)
+    values : ndarray
+      Column values in sorted order, i.e. column[order]
+    """
+
+    def __init__(self, order, values):
+        self.order = order
+        self.values = values
+
+    @classmethod
+    def from_column(cls, column):
+        """ Build the index of a column
+
+        Parameters
+        ----------
+        column : ndarray or Column
+
+        Returns
+        -------
+        ColumnIndex
+
+        """
+        column = np.asarray(column)
+        order = np.argsort(column, kind='mergesort')
+        return cls(order, column[order])
+
+    @classmethod
+    def from_hdf(cls, grp, decode=False):
+        """ Load an index written with write()
+
+        Parameters
+        ----------
+        grp : h5py.Group
+        decode : bool, optional
+          Decode byte strings to str
+
+        Returns
+        -------
+        ColumnIndex
+
+        """
+        values = grp['values'][()]
+        if decode and (values.dtype.kind == 'S'):
+            from specdb.utils import decode_array
+            values = decode_array(values)
+        return cls(grp['order'][()], values)
+
+    def write(self, grp, key):
+        """ Write the index to a DB file, as grp/key/order and grp/key/values
+
+        Parameters
+        ----------
+        grp : h5py.Group
+          Must be writeable
+        key : str
+        """
+        if key in grp.keys():
+            del grp[key]
+        kgrp = grp.create_group(key)
+        kgrp['order'] = self.order
+        values = self.values
+        if values.dtype.kind == 'U':
+            values = values.astype('S')
+        kgrp['values'] = values
+
+    def lookup(self, values):
+        """ Locate values in the sorted column
+
+        Parameters
+        ----------
+        values : ndarray
+
+        Returns
+        -------
+        i0 : int ndarray
+        i1 : int ndarray
+          self.order[i0[i]:i1[i]] are the rows with value values[i];
+          i0 == i1 if there are none
+        """
+        values = np.asarray(values)
+        i0 = np.searchsorted(self.values, values, side='left')
+        i1 = np.searchsorted(self.values, values, side='right')
+        if values.dtype.kind == 'f':  # NaN never matches
+            nan = np.isnan(values)
+            i1[nan] = i0[nan]
+        return i0, i1
+
+    def match(self, values, require_in_match=True):
+        """ Rows aligned with the input values;  same conventions as
+        cat_utils.match_ids.  If a value occurs in more than one row,
+        the first is returned
+
+        Parameters
+        ----------
+        values : ndarray
+        require_in_match : bool, optional
+          Require that each of the input values occurs in the column
+
+        Returns
+        -------
+        rows : int ndarray
+          -1 if there is no match
+        """
+        i0, i1 = self.lookup(values)
+        found = i1 > i0
+        if require_in_match:
+            if np.sum(~found) > 0:
+                raise IOError("qcat.match_ids: One or more input IDs not in match_IDs")
+        rows = -1 * np.ones(i0.shape, dtype=int)
+        rows[found] = self.order[i0[found]]
+        return rows
+
+    def rows_in(self, values):
+        """ Rows whose value is in the input list
+
+        Parameters
+        ----------
+        values : ndarray
+          Should have the dtype of the column
+
+        Returns
+        -------
+        rows : int ndarray
+          Sorted
+        """
+        i0, i1 = self.lookup(np.unique(values))
+        return np.sort(self.order[ranges_to_indices(i0, i1)])
+
+    def rows_between(self, vmin, vmax):
+        """ Rows with vmin <= value <= vmax
+
+        Parameters
+        ----------
+        vmin : float or str
+        vmax : float or str
+
+        Returns
+        -------
+        rows : int ndarray
+          Sorted
+        """
+        if not (vmin <= vmax):  # Includes NaN
+            return np.zeros(0, dtype=int)
+        i0 = np.searchsorted(self.values, vmin, side='left')
+        i1 = np.searchsorted(self.values, vmax, side='right')
+        return np.sort(self.order[i0:i1])
+
+    def __len__(self):
+        return len(self.order)
+
+    def __repr__(self):
+        txt = '<{:s}: nrow={:d}, dtype={}>'.format(self.__class__.__name__, len(self),
+                                                   self.values.dtype)
+        return (txt)
+
+
+class ColumnIndexes(object):
+    """ The indexes of a set of columns of one table
+    Each is built the first time it is requested
+
+    Parameters
+    ----------
+    get_column : callable
+      Returns the column (ndarray) for a key
+    keys : list, optional
+      Columns to index
+    """
+
+    def __init__(self, get_column, keys=None):
+        self.get_column = get_column
+        self.keys = [] if keys is None else list(keys)
+        self._indexes = {}
+        self._stored = {}
+
+    def load(self, grp, decode=False):
+        """ Add the indexes saved in a DB file;  each is read
+        the first time it is requested
+
+        Parameters
+        ----------
+        grp : h5py.Group
+          Holds one sub-group per column
+        decode : bool, optional
+          Decode byte strings to str
+        """
+        for key in grp.keys():
+            self.add(key)
+            self._stored[key] = (grp[key], decode)
+
+    def add(self, key, index=None):
+        """ Add a column to the set
+
+        Parameters
+        ----------
+        key : str
+        index : ColumnIndex, optional
+          Otherwise it is built when first requested
+        """
+        if key not in self.keys:
+            self.keys.append(key)
+        if index is not None:
+            self._indexes[key] = index
+
+    def get(self, key):
+        """ Return the index of a column
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        index : ColumnIndex or None
+          None if the column is not in the set
+        """
+        if key not in self.keys:
+            return None
+        if key not in self._indexes:
+            if key in self._stored:
+                self._indexes[key] = ColumnIndex.from_hdf(*self._stored[key])
+            else:
+                self._indexes[key] = ColumnIndex.from_column(self.get_column(key))
+        return self._indexes[key]
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __repr__(self):
+        txt = '<{:s}: keys={}>'.format(self.__class__.__name__, self.keys)
+        return (txt)
+
+
+def ranges_to_indices(i0, i1):
+    """ Concatenate a set of ranges of indices, without a loop
+
+    Parameters
+    ----------
+    i0 : int ndarray
+      Starts
+    i1 : int ndarray
+      Ends (exclusive)
+
+    Returns
+    -------
+    indices : int ndarray
+      i0[0], i0[0]+1, ..., i1[0]-1, i0[1], ...
+    """
+    nval = np.maximum(np.asarray(i1) - np.asarray(i0), 0)
+    ntot = int(np.sum(nval))
+    if ntot == 0:
+        return np.zeros(0, dtype=int)
+    starts = np.repeat(i0, nval)
+    offsets = np.arange(ntot) - np.repeat(np.cumsum(nval)-nval, nval)
+    return starts + offsets
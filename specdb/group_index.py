@@ -0,0 +1,180 @@
+""" Module for the index of group membership of the catalog sources
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import pdb
+
+from specdb.sky_index import INDEX_GROUP
+
+
+class GroupIndex(object):
+    """ Group membership of the catalog sources as packed bitmaps,
+    one per group, over the rows of the catalog
+
+    Multi-group queries are intersections (AND) or unions (OR)
+    of the bitmaps, 8 rows per byte.
+
+    Parameters
+    ----------
+    nrow : int
+      Number of rows in the catalog
+    bitmaps : dict
+      Packed (np.packbits) bool array for each group
+    group_dict : dict, optional
+      Flag of each group;  bitmaps of groups not in bitmaps are built
+      from flag_group when first requested
+    get_flags : callable, optional
+      Returns the flag_group column of the catalog
+    """
+
+    def __init__(self, nrow, bitmaps=None, group_dict=None, get_flags=None):
+        self.nrow = nrow
+        self.bitmaps = {} if bitmaps is None else dict(bitmaps)
+        self.group_dict = {} if group_dict is None else group_dict
+        self.get_flags = get_flags
+
+    @classmethod
+    def from_flags(cls, flags, group_dict):
+        """ Build the bitmaps of all of the groups
+
+        Parameters
+        ----------
+        flags : int ndarray
+          flag_group column of the catalog
+        group_dict : dict
+
+        Returns
+        -------
+        GroupIndex
+
+        """
+        flags = np.asarray(flags)
+        bitmaps = {}
+        for group, flag in group_dict.items():
+            bitmaps[group] = np.packbits((flags & flag) != 0)
+        return cls(flags.size, bitmaps=bitmaps, group_dict=group_dict)
+
+    @classmethod
+    def from_hdf(cls, hdf, group_dict=None, get_flags=None):
+        """ Load the bitmaps from a DB file
+
+        Parameters
+        ----------
+        hdf : h5py.File
+        group_dict : dict, optional
+        get_flags : callable, optional
+          See GroupIndex
+
+        Returns
+        -------
+        GroupIndex or None
+          None if the DB file has no group index
+
+        """
+        try:
+            ggrp = hdf[INDEX_GROUP+'/groups']
+        except KeyError:
+            return None
+        bitmaps = {}
+        for group in ggrp.keys():
+            bitmaps[group] = ggrp[group][()]
+        return cls(int(ggrp.attrs['NROW']), bitmaps=bitmaps, group_dict=group_dict,
+                   get_flags=get_flags)
+
+    def write(self, hdf):
+        """ Write the bitmaps to a DB file
+
+        Parameters
+        ----------
+        hdf : h5py.File
+          Must be writeable
+        """
+        grp = hdf.require_group(INDEX_GROUP)
+        if 'groups' in grp.keys():
+            del grp['groups']
+        ggrp = grp.create_group('groups')
+        ggrp.attrs['NROW'] = self.nrow
+        for group in self.group_dict:
+            ggrp[group] = self.bitmap(group)
+
+    def bitmap(self, group):
+        """ Packed bitmap of a group
+
+        Parameters
+        ----------
+        group : str
+
+        Returns
+        -------
+        bitmap : uint8 ndarray
+        """
+        if group not in self.bitmaps:
+            if (group not in self.group_dict) or (self.get_flags is None):
+                raise IOError("Group {:s} is not in the group index".format(group))
+            flags = np.asarray(self.get_flags())
+            self.bitmaps[group] = np.packbits((flags & self.group_dict[group]) != 0)
+        return self.bitmaps[group]
+
+    def combine(self, groups, in_all=True):
+        """ Bitmap of the rows in all (AND) or any (OR) of a set of groups
+
+        Parameters
+        ----------
+        groups : list
+        in_all : bool, optional
+
+        Returns
+        -------
+        bitmap : uint8 ndarray
+        """
+        if len(groups) == 0:
+            return np.packbits(np.full(self.nrow, in_all, dtype=bool))
+        bitmap = self.bitmap(groups[0]).copy()
+        for group in groups[1:]:
+            if in_all:
+                bitmap &= self.bitmap(group)
+            else:
+                bitmap |= self.bitmap(group)
+        return bitmap
+
+    def select(self, groups, in_all=True):
+        """ Catalog rows in all (or any) of a set of groups
+
+        Parameters
+        ----------
+        groups : list
+        in_all : bool, optional
+
+        Returns
+        -------
+        good : bool ndarray
+          One per catalog row
+        """
+        return np.unpackbits(self.combine(groups, in_all=in_all))[:self.nrow].astype(bool)
+
+    def contains(self, groups, rows, in_all=True):
+        """ Test whether a set of catalog rows are in all (or any)
+        of a set of groups
+
+        Parameters
+        ----------
+        groups : str or list
+        rows : int ndarray
+        in_all : bool, optional
+
+        Returns
+        -------
+        good : bool ndarray
+          Aligned with rows
+        """
+        if not isinstance(groups, (list, tuple)):
+            groups = [groups]
+        rows = np.asarray(rows, dtype=int)
+        bitmap = self.combine(groups, in_all=in_all)
+        return ((bitmap[rows >> 3] >> (7 - (rows & 7))) & 1).astype(bool)
+
+    def __repr__(self):
+        txt = '<{:s}: nrow={:d}, groups={}>'.format(self.__class__.__name__, self.nrow,
+                                                     sorted(self.bitmaps.keys()))
+        return (txt)
@@ -6,6 +6,629 @@ from __future__ import print_function, absolute_import, division, unicode_litera
 import numpy as np
 import pdb
 
+from collections import OrderedDict
+
+# Wavelength encodings;  TYPE in the wave_solution dataset
+WAVE_EXPLICIT = 0  # Stored in the wave_explicit dataset
+WAVE_LINEAR = 1  # wave = WV0 + DWV*pix
+WAVE_LOGLINEAR = 2  # log10(wave) = WV0 + DWV*pix
+wave_solution_dtype = [(str('TYPE'), 'int8'), (str('WV0'), 'float64'), (str('DWV'), 'float64'),
+                       (str('NPIX'), 'int64'), (str('OFFSET'), 'int64')]
+
+
+def plan_reads(rows, max_gap=0):
+    """ Plan the reads of a set of rows from a dataset
+    The unique rows are sorted and merged into contiguous runs
+
+    Parameters
+    ----------
+    rows : int ndarray
+      May be unordered and include repeats
+    max_gap : int, optional
+      Runs separated by this many (unrequested) rows or fewer are merged
+      into one read
+
+    Returns
+    -------
+    urows : int ndarray
+      Sorted, unique rows
+    inv : int ndarray
+      urows[inv] == rows
+    runs : list of tuple
+      (i0, i1) indices into urows of each read;  the read covers
+      rows urows[i0] through urows[i1-1]
+    """
+    urows, inv = np.unique(np.asarray(rows, dtype=int), return_inverse=True)
+    breaks = np.where(np.diff(urows) > max_gap+1)[0] + 1
+    i0s = np.concatenate([[0], breaks])
+    i1s = np.concatenate([breaks, [urows.size]])
+    runs = [(int(i0), int(i1)) for i0, i1 in zip(i0s, i1s) if i1 > i0]
+    return urows, inv, runs
+
+
+def read_rows(dset, rows, max_gap=None, pool=None):
+    """ Read a set of rows from an HDF5 dataset with one hyperslab
+    per contiguous run, instead of a point selection
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+    rows : int ndarray
+      May be unordered and include repeats
+    max_gap : int, optional
+      See plan_reads.  Default is one chunk of rows less one, so that
+      rows sharing a chunk are read (and decompressed) together
+    pool : concurrent.futures.Executor, optional
+      Decompress the chunks in these threads;  see read_rows_threaded
+
+    Returns
+    -------
+    data : ndarray
+      Aligned with the input rows
+    """
+    if (pool is not None) and (chunk_filters(dset) is not None):
+        return read_rows_threaded(dset, rows, pool)
+    if max_gap is None:
+        max_gap = 0 if dset.chunks is None else dset.chunks[0]-1
+    urows, inv, runs = plan_reads(rows, max_gap=max_gap)
+    data = np.empty((urows.size,)+dset.shape[1:], dtype=dset.dtype)
+    for i0, i1 in runs:
+        r0, r1 = urows[i0], urows[i1-1]+1
+        if (r1-r0) == (i1-i0):  # No gaps
+            dset.read_direct(data, np.s_[r0:r1], np.s_[i0:i1])
+        else:
+            data[i0:i1] = dset[r0:r1][urows[i0:i1]-r0]
+    # Scatter back to the input order
+    return data[inv]
+
+
+def chunk_filters(dset):
+    """ Filter pipeline of a dataset, if its chunks can be
+    decompressed outside of HDF5 (gzip and shuffle only)
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+
+    Returns
+    -------
+    filters : list or None
+      Filter codes, in pipeline order.  None if the dataset is not a
+      1D chunked dataset or uses another filter
+    """
+    from h5py import h5z
+    if (not hasattr(dset, 'id')) or (dset.chunks is None) or (len(dset.shape) != 1):
+        return None
+    dcpl = dset.id.get_create_plist()
+    filters = [dcpl.get_filter(ii)[0] for ii in range(dcpl.get_nfilters())]
+    if not set(filters) <= set([h5z.FILTER_DEFLATE, h5z.FILTER_SHUFFLE]):
+        return None
+    return filters
+
+
+def inflate_chunk(filter_mask, buf, filters, dtype, nrow):
+    """ Decompress one raw chunk, as read by read_direct_chunk
+    zlib releases the GIL, so this may run in threads
+
+    Parameters
+    ----------
+    filter_mask : int
+      Bit i is set if filter i was skipped for this chunk
+    buf : bytes
+    filters : list
+      From chunk_filters
+    dtype : np.dtype
+    nrow : int
+      Rows per chunk
+
+    Returns
+    -------
+    chunk : ndarray
+    """
+    import zlib
+    from h5py import h5z
+    for ii in range(len(filters)-1, -1, -1):
+        if filter_mask & (1 << ii):
+            continue
+        if filters[ii] == h5z.FILTER_DEFLATE:
+            buf = zlib.decompress(buf)
+        else:  # Shuffle
+            buf = np.frombuffer(buf, dtype=np.uint8).reshape(dtype.itemsize, nrow).T.tobytes()
+    return np.frombuffer(buf, dtype=dtype, count=nrow)
+
+
+def read_rows_threaded(dset, rows, pool):
+    """ Read a set of rows from a gzip compressed dataset, decompressing
+    its chunks in a pool of threads
+
+    h5py serializes all calls into HDF5 with a global lock, so threads
+    reading through h5py (even with their own file handles) run one at
+    a time.  Here only the raw (compressed) chunks are read through h5py;
+    zlib, which releases the GIL, inflates them concurrently.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+      Must pass chunk_filters
+    rows : int ndarray
+      May be unordered and include repeats
+    pool : concurrent.futures.Executor
+
+    Returns
+    -------
+    data : ndarray
+      Aligned with the input rows
+    """
+    filters = chunk_filters(dset)
+    nrow = dset.chunks[0]
+    urows, inv = np.unique(np.asarray(rows, dtype=int), return_inverse=True)
+    ichunks = np.unique(urows // nrow)
+    # Read each chunk and hand it to the pool;  decompression overlaps the reads
+    futures = []
+    for ichunk in ichunks:
+        filter_mask, buf = dset.id.read_direct_chunk((int(ichunk)*nrow,))
+        futures.append(pool.submit(inflate_chunk, filter_mask, buf, filters, dset.dtype, nrow))
+    # Collect
+    data = np.empty(urows.size, dtype=dset.dtype)
+    i0s = np.searchsorted(urows, ichunks*nrow)
+    i1s = np.searchsorted(urows, (ichunks+1)*nrow)
+    for ichunk, i0, i1, future in zip(ichunks, i0s, i1s, futures):
+        data[i0:i1] = future.result()[urows[i0:i1]-ichunk*nrow]
+    # Scatter back to the input order
+    return data[inv]
+
+
+def memmap_spec(dset):
+    """ Memory map a contiguous, uncompressed dataset straight from the
+    DB file;  slicing it then only reads the pages touched
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+
+    Returns
+    -------
+    spec : np.memmap or None
+      None if the dataset is chunked (or compressed) or not yet written
+    """
+    if dset.chunks is not None:
+        return None
+    offset = dset.id.get_offset()
+    if (offset is None) or (dset.id.get_type().get_size() != dset.dtype.itemsize):
+        return None
+    return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype, offset=offset,
+                     shape=dset.shape)
+
+
+def open_spec(hdf, group):
+    """ The spectra of a group:  its spec dataset, or a FlatSpec
+    for the flat layout
+
+    Parameters
+    ----------
+    hdf : h5py.File
+    group : str
+
+    Returns
+    -------
+    spec : h5py.Dataset or FlatSpec
+    """
+    if 'spec_flat' in hdf[group].keys():
+        return FlatSpec(hdf[group])
+    return hdf[group]['spec']
+
+
+def read_shard(db_file, group, rows, shm_name, nrow, dtype, i0):
+    """ Read a set of rows of the spectra of a group in a separate process
+    and write them into shared memory;  see read_rows_sharded
+
+    Parameters
+    ----------
+    db_file : str
+    group : str
+    rows : int ndarray
+      Sorted, unique
+    shm_name : str
+      Name of the SharedMemory block
+    nrow : int
+      Rows of the output array in the block
+    dtype : np.dtype
+    i0 : int
+      Output row of the first input row
+    """
+    import h5py
+    from multiprocessing import shared_memory
+    try:
+        import hdf5plugin
+    except ImportError:
+        pass
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        data = np.ndarray((nrow,), dtype=dtype, buffer=shm.buf)
+        with h5py.File(db_file, 'r') as hdf:
+            data[i0:i0+rows.size] = read_rows(open_spec(hdf, group), rows)
+        del data
+    finally:
+        shm.close()
+
+
+def read_rows_sharded(pool, db_file, group, rows, dtype, chunk_rows=1, processes=None,
+                      nshard=None):
+    """ Read a set of rows of the spectra of a group with a pool of
+    processes, each of which opens the DB file itself
+
+    The rows are split into shards on chunk boundaries, so no chunk is
+    decompressed twice, and the workers write straight into one
+    shared memory block (no pickling of the spectra).
+
+    Parameters
+    ----------
+    pool : concurrent.futures.ProcessPoolExecutor
+    db_file : str
+    group : str
+    rows : int ndarray
+      May be unordered and include repeats
+    dtype : np.dtype
+      Of the rows, e.g. InterfaceGroup.spec.dtype
+    chunk_rows : int, optional
+      Rows per chunk of the spec dataset
+    processes : int, optional
+      Number of workers of the pool;  default is the number of CPUs
+    nshard : int, optional
+      Number of shards;  default is 4 per worker
+
+    Returns
+    -------
+    data : ndarray
+      Aligned with the input rows
+    """
+    import multiprocessing
+    from multiprocessing import shared_memory
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if nshard is None:
+        nshard = 4*processes
+    dtype = np.dtype(dtype)
+    urows, inv = np.unique(np.asarray(rows, dtype=int), return_inverse=True)
+    if urows.size == 0:
+        return np.zeros(0, dtype=dtype)
+    # Shard on chunk boundaries, balancing the number of chunks
+    ichunks = np.unique(urows // chunk_rows)
+    bounds = [ichunks[0]] + [sub[-1]+1 for sub in np.array_split(ichunks, min(nshard, ichunks.size))]
+    starts = np.searchsorted(urows, np.array(bounds)*chunk_rows)
+    # Shared output
+    shm = shared_memory.SharedMemory(create=True, size=max(urows.size*dtype.itemsize, 1))
+    try:
+        futures = [pool.submit(read_shard, db_file, group, urows[i0:i1], shm.name, urows.size,
+                               dtype, i0) for i0, i1 in zip(starts[:-1], starts[1:]) if i1 > i0]
+        for future in futures:
+            future.result()
+        # Scatter back to the input order (a copy)
+        data = np.ndarray((urows.size,), dtype=dtype, buffer=shm.buf)[inv]
+    finally:
+        shm.close()
+        shm.unlink()
+    return data
+
+
+def fit_wave_solution(wave, tol=0.01):
+    """ Describe a wavelength array by a linear or log-linear
+    solution, if it is one
+
+    Parameters
+    ----------
+    wave : ndarray
+    tol : float, optional
+      Maximum deviation of the solution from the input, in pixels
+
+    Returns
+    -------
+    wtype : int
+      WAVE_LINEAR, WAVE_LOGLINEAR or WAVE_EXPLICIT (no solution)
+    wv0 : float
+    dwv : float
+    """
+    wave = np.asarray(wave, dtype=float)
+    npix = wave.size
+    if npix < 2:
+        return WAVE_EXPLICIT, 0., 0.
+    pix = np.arange(npix)
+    dpix = np.abs(np.diff(wave))
+    dpix = np.concatenate([dpix[:1], dpix])  # Local pixel size
+    for wtype in [WAVE_LINEAR, WAVE_LOGLINEAR]:
+        if wtype == WAVE_LINEAR:
+            xval = wave
+        else:
+            if np.any(wave <= 0.):
+                continue
+            xval = np.log10(wave)
+        wv0 = xval[0]
+        dwv = (xval[-1]-xval[0]) / (npix-1)
+        model = wv0 + dwv*pix
+        if wtype == WAVE_LOGLINEAR:
+            model = 10**model
+        if np.all(np.abs(model-wave) <= tol*dpix):
+            return wtype, wv0, dwv
+    return WAVE_EXPLICIT, 0., 0.
+
+
+def synthesize_wave(solution, width):
+    """ Generate wavelength arrays from their solutions
+
+    Parameters
+    ----------
+    solution : ndarray
+      Rows of the wave_solution dataset
+    width : int
+      Number of pixels of the output arrays
+
+    Returns
+    -------
+    wave : ndarray (nrow, width)
+      Padded with 0 beyond NPIX.  Rows with WAVE_EXPLICIT are all 0
+    """
+    pix = np.arange(width)
+    wave = solution['WV0'][:, None] + solution['DWV'][:, None]*pix
+    log = solution['TYPE'] == WAVE_LOGLINEAR
+    wave[log] = 10**wave[log]
+    wave[pix >= solution['NPIX'][:, None]] = 0.
+    wave[solution['TYPE'] == WAVE_EXPLICIT] = 0.
+    return wave
+
+
+class FlatSpec(object):
+    """ Read spectra stored in the flat layout as if they were
+    rows of a padded spec dataset
+
+    The pixels of all spectra of a group are concatenated in
+    the spec_flat dataset and spectrum i is
+    spec_flat[spec_offsets[i]:spec_offsets[i+1]].
+    Only the real pixels are read;  rows are padded with 0
+    in memory, to the largest NPIX of the group.
+
+    Parameters
+    ----------
+    grp : h5py.Group
+
+    Attributes
+    ----------
+    npix : int ndarray
+      Number of pixels in each spectrum
+    dtype : np.dtype
+      Of the padded rows
+    """
+
+    def __init__(self, grp):
+        self.pix = grp['spec_flat']
+        self.offsets = grp['spec_offsets'][()]
+        self.npix = np.diff(self.offsets)
+        self.max_npix = int(np.max(self.npix)) if self.npix.size > 0 else 0
+        self.shape = (self.npix.size,)
+        self.size = self.npix.size
+        self.chunks = None
+        self.dtype = np.dtype([(name, self.pix.dtype[name], (self.max_npix,))
+                               for name in self.pix.dtype.names])
+
+    def __getitem__(self, key):
+        """ Read one row (int) or a contiguous set of rows (slice)
+        """
+        if isinstance(key, slice):
+            r0, r1, step = key.indices(self.size)
+            if step != 1:
+                raise IOError("Only contiguous slices are allowed")
+        else:
+            r0, r1 = int(key), int(key)+1
+        data = np.zeros(max(r1-r0, 0), dtype=self.dtype)
+        if r1 > r0:
+            # One read for all of the pixels
+            p0 = self.offsets[r0]
+            pix = self.pix[p0:self.offsets[r1]]
+            for ii, row in enumerate(range(r0, r1)):
+                i0, i1 = self.offsets[row]-p0, self.offsets[row+1]-p0
+                for name in self.dtype.names:
+                    data[name][ii, :i1-i0] = pix[name][i0:i1]
+        if isinstance(key, slice):
+            return data
+        return data[0]
+
+    def read_direct(self, dest, source_sel, dest_sel):
+        """ Mimics h5py.Dataset.read_direct for a slice of rows
+        """
+        dest[dest_sel] = self[source_sel]
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        txt = '<{:s}: nspec={:d}, npixel={:d}, max_npix={:d}>'.format(
+            self.__class__.__name__, self.size, int(self.offsets[-1]), self.max_npix)
+        return (txt)
+
+
+class RowCache(object):
+    """ A least-recently-used cache of rows read from a dataset,
+    limited by the total number of bytes held
+
+    Parameters
+    ----------
+    max_nbytes : int
+      Byte budget;  0 disables the cache
+
+    Attributes
+    ----------
+    nbytes : int
+      Bytes currently held
+    hits : int
+    misses : int
+    """
+
+    def __init__(self, max_nbytes):
+        self.max_nbytes = int(max_nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+
+    def read(self, dset, rows, pool=None):
+        """ Read a set of rows, from the cache where possible.
+        The others are read with read_rows and then cached
+
+        Parameters
+        ----------
+        dset : h5py.Dataset
+        rows : int ndarray
+          May be unordered and include repeats
+        pool : concurrent.futures.Executor, optional
+          Passed to read_rows
+
+        Returns
+        -------
+        data : ndarray
+          Aligned with the input rows
+        """
+        if self.max_nbytes <= 0:
+            return read_rows(dset, rows, pool=pool)
+        urows, inv = np.unique(np.asarray(rows, dtype=int), return_inverse=True)
+        data = np.empty((urows.size,)+dset.shape[1:], dtype=dset.dtype)
+        miss = np.array([int(row) not in self._rows for row in urows], dtype=bool)
+        # Hits (and mark as most recently used)
+        for ii in np.where(~miss)[0]:
+            row = int(urows[ii])
+            self._rows[row] = self._rows.pop(row)
+            data[ii] = self._rows[row]
+        # Misses
+        if np.any(miss):
+            data[miss] = read_rows(dset, urows[miss], pool=pool)
+            for ii in np.where(miss)[0]:
+                self.put(int(urows[ii]), data[ii].copy())
+        self.hits += int(np.sum(~miss))
+        self.misses += int(np.sum(miss))
+        return data[inv]
+
+    def put(self, row, value):
+        """ Add a row to the cache, evicting the least recently used
+        rows if over budget
+
+        Parameters
+        ----------
+        row : int
+        value : ndarray or np.void
+        """
+        nbytes = value.nbytes
+        if nbytes > self.max_nbytes:
+            return
+        if row in self._rows:
+            self.nbytes -= self._rows.pop(row).nbytes
+        self._rows[row] = value
+        self.nbytes += nbytes
+        while self.nbytes > self.max_nbytes:
+            _, old = self._rows.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        """ Empty the cache and reset the counters
+        """
+        self._rows.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, row):
+        return row in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        txt = '<{:s}: nrows={:d}, nbytes={:d}, max_nbytes={:d}, hits={:d}, misses={:d}>'.format(
+            self.__class__.__name__, len(self), self.nbytes, self.max_nbytes, self.hits, self.misses)
+        return (txt)
+
+
+class MemoryBudget(object):
+    """ Ledger of the bytes of spectra handed out, against a budget
+
+    Each array (or spectrum object) handed out is entered with its size
+    and released from the ledger when it is garbage collected.
+
+    Parameters
+    ----------
+    max_Gb : float
+      Budget
+
+    Attributes
+    ----------
+    nbytes : int
+      Bytes handed out and still in use
+    """
+
+    def __init__(self, max_Gb):
+        self.max_nbytes = int(max_Gb*1e9)
+        self.nbytes = 0
+
+    @property
+    def available(self):
+        """ Bytes left in the budget
+        """
+        return self.max_nbytes - self.nbytes
+
+    def hand_out(self, obj, nbytes):
+        """ Enter an object in the ledger
+
+        Parameters
+        ----------
+        obj : object
+          Must support weak references (e.g. ndarray, XSpectrum1D)
+        nbytes : int
+        """
+        import weakref
+        nbytes = int(nbytes)
+        self.nbytes += nbytes
+        weakref.finalize(obj, self.release, nbytes)
+
+    def release(self, nbytes):
+        """ Remove bytes from the ledger
+
+        Parameters
+        ----------
+        nbytes : int
+        """
+        self.nbytes -= nbytes
+
+    def batches(self, nrow, row_nbytes, out_nbytes):
+        """ Split a request into batches of rows that fit the budget,
+        with the output of the request held in full
+
+        For an output streamed batch by batch, include its bytes per
+        row in row_nbytes and set out_nbytes to 0.
+
+        Parameters
+        ----------
+        nrow : int
+          Number of rows requested
+        row_nbytes : int
+          Bytes of one row held while its batch is read
+        out_nbytes : int
+          Bytes of the output held in full
+
+        Returns
+        -------
+        batches : list of slice or None
+          Empty if nrow is 0.  None if the request does not fit,
+          even one row at a time
+        """
+        free = self.available - out_nbytes
+        if free < row_nbytes:
+            return None
+        nbatch = max(min(int(free // max(row_nbytes, 1)), nrow), 1)
+        return [slice(i0, i0+nbatch) for i0 in range(0, nrow, nbatch)]
+
+    def __repr__(self):
+        txt = '<{:s}: nbytes={:d}, max_nbytes={:d}>'.format(
+            self.__class__.__name__, self.nbytes, self.max_nbytes)
+        return (txt)
+
+
 def show_group_meta(meta, meta_keys=None, show_all_keys=True):
     """ Show (nicely) a set of meta data
 
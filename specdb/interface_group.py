@@ -14,8 +14,9 @@ from astropy.table import Table
 
 from linetools.spectra.xspectrum1d import XSpectrum1D
 
-from specdb.cat_utils import match_ids
-from specdb.group_utils import show_group_meta
+from specdb.column_index import ColumnIndexes
+from specdb.group_utils import show_group_meta, RowCache, FlatSpec, MemoryBudget
+from specdb.group_utils import synthesize_wave, read_rows_sharded, memmap_spec, WAVE_EXPLICIT
 from specdb import utils as spdbu
 
 class InterfaceGroup(object):
@@ -26,22 +27,46 @@ class InterfaceGroup(object):
 
     Attributes
     ----------
+    meta : Table
+      Meta data of the group;  may hold only a subset of the columns
+    meta_keys : list
+      All of the columns of the meta data in the DB file
+    indexes : ColumnIndexes
+      Sorted indexes of meta columns (ID key and GROUP_ID);  each is built on first use
     memory_used : float
-      Used memory in Gb
+      Used memory (RSS) in Gb, sampled by update()
     memory_warning : float
       Value at which a Warning is raised
     hdf : pointer to DB
     maximum_ram : float, optonal
       Maximum memory allowed for the Python session, in Gb
+    budget : MemoryBudget
+      Ledger of the spectra handed out, against maximum_ram
+    spec_layout : str
+      Storage of the spectra in the DB;  padded or flat
+    spec_cache : RowCache
+      Cache of the spectra (rows of the spec dataset) already read
+    memmap : bool
+      Memory map the spec dataset, if it is contiguous and uncompressed
     """
 
-    def __init__(self, hdf, group, idkey, maximum_ram=10., verbose=True, **kwargs):
+    def __init__(self, hdf, group, idkey, maximum_ram=10., verbose=True, cache_Gb=0.,
+                 memmap=False, budget=None, **kwargs):
         """
         Parameters
         ----------
         hdf : h5py.File object
         group : str
         idkey : str
+        cache_Gb : float, optional
+          Size of the cache of spectra read from the DB, in Gb.
+          0 (default) disables the cache.  Its rows are not counted
+          against maximum_ram;  it suits repeated reads of a few rows
+        memmap : bool, optional
+          Memory map the spec dataset, if it is contiguous and uncompressed
+          (see build.privatedb.ingest_spectra).  Otherwise it is read with h5py
+        budget : MemoryBudget, optional
+          Shared with other groups;  default is a new one of maximum_ram
 
         Returns
         -------
@@ -53,21 +78,93 @@ class InterfaceGroup(object):
         self.idkey = idkey
         self.verbose = verbose
         # Load meta
-        self.load_meta(group, **kwargs)
+        self.load_meta(group, lazy=True, **kwargs)
+        self.indexes = ColumnIndexes(lambda key: self.meta[key].data, keys=[idkey, 'GROUP_ID'])
+        if 'index' in self.hdf[group].keys():
+            self.indexes.load(self.hdf[group+'/index'], decode=True)
         # Memory
         self.memory_used = 0.
         self.memory_warning = 5.  # Gb
-        self.memory_max = 10.  # Gb
+        self.memory_max = maximum_ram  # Gb
+        self.budget = MemoryBudget(maximum_ram) if budget is None else budget
         self.update()
+        # Spectra
+        self.spec_layout = spdbu.hdf_decode(self.hdf[group].attrs.get('SPEC_LAYOUT', 'padded'))
+        self._spec = None
+        self.memmap = memmap
+        self.wave_encoded = 'wave_solution' in self.hdf[group].keys()
+        self._wave_solution = None
+        self.spec_cache = RowCache(int(cache_Gb*1e9))
+
+    @property
+    def spec(self):
+        """ The spectra of the group, as rows;  an h5py Dataset for
+        the padded layout and a FlatSpec for the flat layout
+        """
+        if self._spec is None:
+            if self.spec_layout == 'flat':
+                self._spec = FlatSpec(self.hdf[self.group])
+            else:
+                self._spec = self.hdf[self.group]['spec']
+                if self.memmap:
+                    spec = memmap_spec(self._spec)
+                    if spec is not None:
+                        self._spec = spec
+                    elif self.verbose:
+                        print("The spectra of {:s} are not contiguous;  not memory mapped".format(self.group))
+        return self._spec
+
+    @property
+    def wave_solution(self):
+        """ Wavelength solutions of the spectra;  only for a group
+        with wave_encoded=True
+        """
+        if self._wave_solution is None:
+            self._wave_solution = self.hdf[self.group]['wave_solution'][()]
+        return self._wave_solution
+
+    def grab_wave(self, rows, width):
+        """ Generate the wavelength arrays for a set of rows of a
+        group whose wavelengths are encoded
+
+        Parameters
+        ----------
+        rows : int ndarray
+        width : int
+          Number of pixels of the output arrays
 
-    def load_meta(self, group, reformat=True):
+        Returns
+        -------
+        wave : ndarray (nrow, width)
+          Padded with 0 beyond NPIX
+        """
+        solution = self.wave_solution[rows]
+        wave = synthesize_wave(solution, width)
+        # Grids without a solution
+        for ii in np.where(solution['TYPE'] == WAVE_EXPLICIT)[0]:
+            i0 = solution['OFFSET'][ii]
+            npix = min(solution['NPIX'][ii], width)
+            wave[ii, :npix] = self.hdf[self.group]['wave_explicit'][i0:i0+npix]
+        return wave
+
+    def load_meta(self, group, reformat=True, meta_columns=None, lazy=False):
         """ Load the meta data as a Table
         Parameters
         ----------
         group : str
+        reformat : bool, optional
+        meta_columns : list, optional
+          Only read these columns (plus GROUP_ID and the ID key) from the DB.
+          Other columns are read when first needed, e.g. by query_meta,
+          or with add_meta_columns
+        lazy : bool, optional
+          Read the table when self.meta is first used;  until then,
+          queries restricted to a set of rows read only those rows
         """
         import json
-        self.meta = spdbu.hdf_decode(self.hdf[group+'/meta'].value, itype='Table')
+        self.meta_keys = list(self.hdf[group+'/meta'].dtype.names)
+        self.meta_columns = meta_columns
+        self._meta = None
         # Attributes
         self.meta_attr = {}
         for key in self.hdf[group+'/meta'].attrs.keys():
@@ -76,20 +173,123 @@ class InterfaceGroup(object):
             else:
                 self.meta_attr[key] = spdbu.hdf_decode(self.hdf[group+'/meta'].attrs[key])
         # Reformat
-        if reformat:
-            try:
-                self.meta['RA_GROUP'].format = '8.4f'
-            except KeyError:  # Backwards compatible, will deprecate
-                self.meta['RA'].format = '8.4f'
-                self.meta['DEC'].format = '8.4f'
-                self.meta['zem'].format = '6.3f'
+        self.reformat = reformat
+        if not lazy:
+            self.meta
+
+    @property
+    def meta(self):
+        """ The meta data of the group as a Table;  read when first used
+        """
+        if self._meta is None:
+            if self.meta_columns is None:
+                self._meta = spdbu.hdf_decode(self.hdf[self.group+'/meta'][()], itype='Table')
             else:
-                self.meta['DEC_GROUP'].format = '8.4f'
-                self.meta['zem_GROUP'].format = '6.3f'
-            self.meta['WV_MIN'].format = '6.1f'
-            self.meta['WV_MAX'].format = '6.1f'
-        # Add group
-        self.meta.meta['group'] = group
+                keys = [key for key in self.meta_keys if (key in self.meta_columns) or (key in ['GROUP_ID', self.idkey])]
+                self._meta = self.read_meta_columns(keys)
+            if self.reformat:
+                self.format_meta(self._meta)
+            # Add group
+            self._meta.meta['group'] = self.group
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+
+    def meta_rows(self, rows):
+        """ Rows of the meta data;  only these rows are read from the DB
+        if the table has not been loaded
+
+        Parameters
+        ----------
+        rows : int ndarray
+          May be unordered and include repeats
+
+        Returns
+        -------
+        meta : Table
+          Aligned with the input rows
+        """
+        if self._meta is not None:
+            return self.meta[rows]
+        rows = np.asarray(rows, dtype=int)
+        urows, inv = np.unique(rows, return_inverse=True)
+        if urows.size == 0:
+            data = self.hdf[self.group+'/meta'][0:0]
+        else:
+            data = self.hdf[self.group+'/meta'][urows]
+        meta = spdbu.hdf_decode(data, itype='Table')
+        if self.meta_columns is not None:
+            meta.keep_columns([key for key in self.meta_keys if (key in self.meta_columns) or (
+                key in ['GROUP_ID', self.idkey])])
+        if self.reformat:
+            self.format_meta(meta)
+        meta.meta['group'] = self.group
+        return meta[inv]
+
+    def format_meta(self, meta=None):
+        """ Set the display format of the (loaded) meta columns
+
+        Parameters
+        ----------
+        meta : Table, optional
+          Defaults to self.meta
+        """
+        if meta is None:
+            meta = self.meta
+        if 'RA_GROUP' in self.meta_keys:
+            formats = dict(RA_GROUP='8.4f', DEC_GROUP='8.4f', zem_GROUP='6.3f')
+        else:  # Backwards compatible, will deprecate
+            formats = dict(RA='8.4f', DEC='8.4f', zem='6.3f')
+        formats.update(dict(WV_MIN='6.1f', WV_MAX='6.1f'))
+        for key, fmt in formats.items():
+            if key in meta.keys():
+                meta[key].format = fmt
+
+    def read_meta_columns(self, keys, group=None):
+        """ Read a set of columns of the meta data from the DB
+        Only these fields are read from disk
+
+        Parameters
+        ----------
+        keys : list
+        group : str, optional
+          Defaults to self.group
+
+        Returns
+        -------
+        meta : Table
+          Decoded
+        """
+        if group is None:
+            group = self.group
+        data = self.hdf[group+'/meta'][tuple(keys)]
+        if len(keys) == 1:  # h5py returns a plain array for a single field
+            data = Table([data], names=keys)
+        return spdbu.hdf_decode(data, itype='Table')
+
+    def add_meta_columns(self, keys):
+        """ Read columns of the meta data that have not yet been loaded
+        and add them to self.meta
+
+        Parameters
+        ----------
+        keys : list
+          Keys not in the DB are ignored
+        """
+        if self._meta is None:  # Read when first used, with these keys
+            if self.meta_columns is not None:
+                self.meta_columns = list(self.meta_columns) + list(keys)
+            return
+        new_keys = [key for key in self.meta_keys if (key in keys) and (key not in self.meta.keys())]
+        if len(new_keys) == 0:
+            return
+        new_meta = self.read_meta_columns(new_keys)
+        for key in new_keys:
+            self.meta[key] = new_meta[key]
+        if self.reformat:
+            self.format_meta()
 
     def groupids_to_rows(self, group_IDs):
         """ Convert GROUP_ID values to rows in the meta table
@@ -108,7 +308,7 @@ class InterfaceGroup(object):
         if isinstance(group_IDs, int):
             group_IDs = np.array([group_IDs])  # Insures meta and other arrays are proper
         # Find rows
-        rows = match_ids(group_IDs, self.meta['GROUP_ID'])
+        rows = self.indexes.get('GROUP_ID').match(group_IDs)
         # Return
         return rows
 
@@ -132,18 +332,12 @@ class InterfaceGroup(object):
         if isinstance(IDs, int):
             IDs = np.array([IDs])  # Insures meta and other arrays are proper
         # Check that input IDs are all covered
-        chk_survey = np.in1d(IDs, self.meta[self.idkey])
-        if np.sum(chk_survey) != IDs.size:
+        id_index = self.indexes.get(self.idkey)
+        i0, i1 = id_index.lookup(IDs)
+        if np.any(i1 == i0):
             raise IOError("Not all of the input IDs are located in requested group: {:s}".format(self.group))
-        # All matching rows
-        match_group = np.in1d(self.meta[self.idkey], IDs)
-        # Find indices of input IDs in meta table -- first instance in meta only!
-        gdi = self.meta[self.idkey].data[match_group]
-        xsorted = np.argsort(gdi)
-        ypos = np.searchsorted(gdi, IDs, sorter=xsorted)
-        indices = xsorted[ypos]  # Location in subset of meta table
-        # Store and return
-        rows = np.where(match_group)[0][indices]
+        # Find rows of input IDs in meta table -- first instance in meta only!
+        rows = id_index.order[i0]
         return rows
 
     def ids_to_allrows(self, IDs):
@@ -170,15 +364,179 @@ class InterfaceGroup(object):
         if isinstance(IDs, int):
             IDs = np.array([IDs])  # Insures meta and other arrays are proper
         # Check that input IDs are all covered
-        try:
-            chk_survey = np.in1d(IDs, self.meta[self.idkey])
-        except:
-            pdb.set_trace()
-        if np.sum(chk_survey) != IDs.size:
+        id_index = self.indexes.get(self.idkey)
+        i0, i1 = id_index.lookup(IDs)
+        if np.any(i1 == i0):
             raise IOError("Not all of the input IDs are located in requested group: {:s}".format(self.group))
-        # Find rows (bool array)
-        match_survey = np.in1d(self.meta[self.idkey], IDs)
-        return np.where(match_survey)[0]
+        # Find rows (binary search of the sorted index)
+        return id_index.rows_in(IDs)
+
+    def grab_data(self, rows, verbose=None, pool=None, process_pool=None, processes=None,
+                  **kwargs):
+        """ Grab the spectral arrays for an input set of rows
+        Aligned to the rows input
+
+        The output is held in full and must fit the memory budget;
+        the reads are batched.  See iter_data for larger requests
+
+        Parameters
+        ----------
+        rows : int or ndarray
+        verbose
+        pool : concurrent.futures.Executor, optional
+          Threads to decompress the spectra in;  see group_utils.read_rows
+        process_pool : concurrent.futures.ProcessPoolExecutor, optional
+          Read the spectra in these processes, bypassing the cache;
+          see group_utils.read_rows_sharded
+        processes : int, optional
+          Number of workers of process_pool
+        kwargs
+
+        Returns
+        -------
+        data : ndarray
+          Fields wave, flux, sig (and co, if stored), each an array of
+          the largest number of pixels in the group (flat layout:  of the rows)
+
+        Raises
+        ------
+        IOError
+          If the output does not fit the memory budget
+        """
+        if isinstance(rows, int):
+            rows = np.array([rows])  # Insures meta and other arrays are proper
+        if verbose is None:
+            verbose = self.verbose
+        dtype = self.data_dtype(rows)
+        # Check memory
+        batches = self.stage_data(rows, out_row_nbytes=dtype.itemsize, verbose=verbose)
+        if batches is False:
+            raise IOError("The {:d} spectra requested exceed the memory budget;  "
+                          "read them in batches with iter_data "
+                          "(or SpecDB.iter_spectra)".format(rows.size))
+        data = self.read_data(rows, batches, dtype, pool=pool, process_pool=process_pool,
+                              processes=processes)
+        if verbose:
+            print("Loaded spectra")
+        return data
+
+    def iter_data(self, rows, verbose=None, pool=None, process_pool=None, processes=None):
+        """ Grab the spectral arrays for an input set of rows in batches
+        that fit the memory budget, output included
+
+        Each batch is entered in the budget when it is yielded;  release
+        it before asking for the next to keep to the budget
+
+        Parameters
+        ----------
+        rows : int ndarray
+        verbose
+        pool : concurrent.futures.Executor, optional
+        process_pool : concurrent.futures.ProcessPoolExecutor, optional
+        processes : int, optional
+          See grab_data
+
+        Returns
+        -------
+        Generator of
+        batch : slice
+          Of rows
+        data : ndarray
+          As for grab_data, for rows[batch]
+        """
+        if verbose is None:
+            verbose = self.verbose
+        rows = np.atleast_1d(rows)
+        dtype = self.data_dtype(rows)
+        batches = self.stage_data(rows, out_row_nbytes=dtype.itemsize, stream=True, verbose=verbose)
+        if batches is False:
+            raise IOError("Not even one spectrum fits in the memory budget")
+        for batch in batches:
+            sub_rows = rows[batch]
+            yield batch, self.read_data(sub_rows, [slice(0, sub_rows.size)],
+                                        self.data_dtype(sub_rows), pool=pool,
+                                        process_pool=process_pool, processes=processes)
+
+    def data_dtype(self, rows):
+        """ dtype of the spectral arrays of a set of rows;  see grab_data
+
+        Parameters
+        ----------
+        rows : int ndarray
+
+        Returns
+        -------
+        dtype : np.dtype
+        """
+        # Trim the padding of the flat layout
+        sdtype = self.spec.dtype
+        if (self.spec_layout == 'flat') and (rows.size > 0):
+            npix = int(np.max(self.spec.npix[rows]))
+        else:
+            npix = sdtype['flux'].shape[0]
+        names = ['wave', 'flux', 'sig'] + (['co'] if 'co' in sdtype.names else [])
+        return np.dtype([(str(name), 'float64' if name == 'wave' else sdtype[name].base,
+                          (npix,)) for name in names])
+
+    def read_data(self, rows, batches, dtype, pool=None, process_pool=None, processes=None):
+        """ Read the spectral arrays of a set of rows, one batch at a time,
+        and enter them in the memory budget
+
+        Parameters
+        ----------
+        rows : int ndarray
+        batches : list of slice
+          From stage_data
+        dtype : np.dtype
+          From data_dtype
+        pool : concurrent.futures.Executor, optional
+        process_pool : concurrent.futures.ProcessPoolExecutor, optional
+        processes : int, optional
+
+        Returns
+        -------
+        data : ndarray
+        """
+        npix = dtype['flux'].shape[0]
+        data = np.empty(rows.size, dtype=dtype)
+        for batch in batches:
+            spec = self.read_spec(rows[batch], pool=pool, process_pool=process_pool,
+                                  processes=processes)
+            for name in dtype.names:
+                if name in spec.dtype.names:
+                    data[name][batch] = spec[name][:, :npix]
+        # Wavelengths;  generated from their solutions if encoded
+        if self.wave_encoded:
+            data['wave'] = self.grab_wave(rows, npix)
+        self.budget.hand_out(data, data.nbytes)
+        return data
+
+    def read_spec(self, rows, pool=None, process_pool=None, processes=None):
+        """ Read rows of the spec dataset (or its memory map, or FlatSpec)
+
+        Parameters
+        ----------
+        rows : int ndarray
+        pool : concurrent.futures.Executor, optional
+        process_pool : concurrent.futures.ProcessPoolExecutor, optional
+        processes : int, optional
+          See grab_data
+
+        Returns
+        -------
+        spec : ndarray
+          Aligned with the input rows
+        """
+        if isinstance(self.spec, np.memmap):
+            return self.spec[rows]  # Only the pages of these rows are read
+        elif process_pool is not None:
+            chunk_rows = 1 if self.spec.chunks is None else self.spec.chunks[0]
+            return read_rows_sharded(process_pool, self.hdf.filename, self.group, rows,
+                                     self.spec.dtype, chunk_rows=chunk_rows,
+                                     processes=processes)
+        else:
+            # Load, one read per contiguous run of rows (or from the cache)
+            return self.spec_cache.read(self.spec, rows, pool=pool)
 
     def grab_specmeta(self, rows, verbose=None, **kwargs):
         """ Grab the spectra and meta data for an input set of rows
@@ -199,30 +557,16 @@ class InterfaceGroup(object):
         """
         if isinstance(rows, int):
             rows = np.array([rows])  # Insures meta and other arrays are proper
-        if verbose is None:
-            verbose = self.verbose
-        # Check memory
-        if self.stage_data(rows, **kwargs):
-            if verbose:
-                print("Loaded spectra")
-            # Load
-            msk = np.array([False]*len(self.meta))
-            msk[rows] = True
-            tmp_data = self.hdf[self.group]['spec'][msk]
-            # Replicate and sort according to input rows
-            idx = match_ids(rows, np.where(msk)[0])
-            data = tmp_data[idx]
-        else:
-            print("Staging failed..  Not returning spectra")
-            return
+        data = self.grab_data(rows, verbose=verbose, **kwargs)
         # Generate XSpectrum1D
         if 'co' in data.dtype.names:
             co = data['co']
         else:
             co = None
         spec = XSpectrum1D(data['wave'], data['flux'], sig=data['sig'], co=co, masking='edges')
+        self.budget.hand_out(spec, data.nbytes)
         # Return
-        return spec, self.meta[rows]
+        return spec, self.meta_rows(rows)
 
     def loop_grab_spec(self, survey, IDs, verbose=None, **kwargs):
         """ Grab spectra using staged IDs
@@ -302,12 +646,15 @@ class InterfaceGroup(object):
         cut_meta = self.meta[rows]
         return cut_meta
 
-    def query_meta(self, qdict, **kwargs):
+    def query_meta(self, qdict, rows=None, **kwargs):
         """
         Parameters
         ----------
         qdict : dict
           Query_dict
+        rows : int ndarray, optional
+          Only query these rows of the meta table, e.g. from the spectra index
+          Must be sorted and unique
 
         Returns
         -------
@@ -316,8 +663,17 @@ class InterfaceGroup(object):
           Subset of the meta table matching the query
         IDs : int ndarray
         """
+        # Load any columns required by the query
+        self.add_meta_columns(spdbu.query_keys(qdict))
         # Query
-        matches = spdbu.query_table(self.meta, qdict, tbl_name='meta data')
+        if rows is not None:
+            # Only these rows are read, unless the table is loaded
+            sub_meta = self.meta_rows(rows)
+            sub_matches = spdbu.query_table(sub_meta, qdict, tbl_name='meta data')
+            matches = np.zeros(self.hdf[self.group+'/meta'].shape[0], dtype=bool)
+            matches[rows[sub_matches]] = True
+            return matches, sub_meta[sub_matches], sub_meta[self.idkey][sub_matches].data
+        matches = spdbu.query_table(self.meta, qdict, tbl_name='meta data', indexes=self.indexes)
 
         # Return
         return matches, self.meta[matches], self.meta[self.idkey][matches].data
@@ -337,12 +693,13 @@ class InterfaceGroup(object):
         # Show
         show_group_meta()
 
-    def spec_from_meta(self, meta):
+    def spec_from_meta(self, meta, **kwargs):
         """ Return spectra aligned to input meta table
 
         Parameters
         ----------
         meta : Table
+        kwargs : passed to grab_specmeta
 
         Returns
         -------
@@ -351,38 +708,51 @@ class InterfaceGroup(object):
         """
         rows = self.groupids_to_rows(meta['GROUP_ID'])
         # Grab spectra
-        spec, _ = self.grab_specmeta(rows)
+        spec, _ = self.grab_specmeta(rows, **kwargs)
         # Return
         return spec
 
-    def stage_data(self, rows, verbose=None, **kwargs):
+    def stage_data(self, rows, out_row_nbytes=None, stream=False, verbose=None, **kwargs):
         """ Stage the spectra for serving
-        Mainly checks the memory
+        Checks the request against the memory budget and splits the
+        reads into batches that fit it
 
         Parameters
         ----------
         rows : ndarray
           Indices of desired data
+        out_row_nbytes : int, optional
+          Size of the output of one row;  default is the size of a row as stored
+        stream : bool, optional
+          The output is handed out batch by batch (iter_data), rather
+          than held in full (grab_data)
 
         Returns
         -------
-        check : bool
-        If True, self.survey_IDs is filled
-          Indices in the survey dataset
+        batches : list of slice or False
+          Slices of rows to read one batch at a time;  empty if there are no rows
+          False if the request does not fit the budget
 
         """
         if verbose is None:
             verbose = self.verbose
-        # Memory check (approximate; ignores meta data)
-        spec_Gb = self.hdf[self.group]['spec'][0].nbytes/1e9  # Gb
-        new_memory = spec_Gb*rows.size
-        if new_memory + self.memory_used > self.memory_max:
+        self.update()
+        # Memory check, from the dtype (ignores meta data)
+        row_nbytes = self.spec.dtype.itemsize
+        if out_row_nbytes is None:
+            out_row_nbytes = row_nbytes
+        out_nbytes = out_row_nbytes*rows.size
+        if stream:
+            batches = self.budget.batches(rows.size, row_nbytes+out_row_nbytes, 0)
+        else:
+            batches = self.budget.batches(rows.size, row_nbytes, out_nbytes)
+        if batches is None:
             warnings.warn("This request would exceed your maximum memory limit of {:g} Gb".format(self.memory_max))
             return False
-        else:
-            if verbose:
-                print("Staged {:d} spectra totalling {:g} Gb".format(len(rows), new_memory))
-            return True
+        if verbose:
+            print("Staged {:d} spectra totalling {:g} Gb in {:d} batch(es)".format(
+                len(rows), out_nbytes/1e9, len(batches)))
+        return batches
 
     def update(self):
         """ Update key attributes
@@ -11,11 +11,13 @@ import warnings
 from astropy.table import Table
 from astropy import units as u
 from astropy.units import Quantity
-from astropy.coordinates import SkyCoord, match_coordinates_sky, Angle
+from astropy.coordinates import SkyCoord, Angle
 
 from linetools import utils as ltu
 
-from specdb.cat_utils import match_ids
+from specdb.sky_index import SkyIndex, CoordTree, INDEX_GROUP
+from specdb.column_index import ColumnIndexes
+from specdb.group_index import GroupIndex
 from specdb import utils as spdbu
 
 try:
@@ -29,16 +31,42 @@ class QueryCatalog(object):
 
     Parameters
     ----------
+    tree_file : str or bool, optional
+      Sidecar .npz file in which to save (and from which to load) the
+      KD-tree of the catalog.  If True, the name is generated from
+      the DB file.  Default is to build the tree in memory only
+    lazy : bool, optional
+      Do not read the catalog at startup.  Columns are read from
+      the DB file as they are needed and the full Table is only
+      generated if self.cat is accessed
+    index_keys : list, optional
+      Catalog columns to index (sorted) for query_dict;  the
+      ID key is always indexed
 
     Attributes
     ----------
     cat : Table
       Astropy Table holding the IGMspec catalog
+    nsource : int
+      Number of sources in the catalog
+    coords : SkyCoord
+      Coordinates of the catalog;  generated on first use
     groups : list
       List of groups included in the catalog
+    sky_index : SkyIndex
+      Positional index of the catalog;  read from the DB file
+      if present, otherwise built on first use
+    coord_tree : CoordTree
+      KD-tree of the catalog used for coordinate matching;  built on first use
+    group_index : GroupIndex
+      Group membership of the sources as bitmaps;  read from the DB file
+      if present, otherwise built on first use
+    indexes : ColumnIndexes
+      Sorted indexes of catalog columns;  each is built on first use
     """
 
-    def __init__(self, hdf, maximum_ram=10., verbose=False, **kwargs):
+    def __init__(self, hdf, maximum_ram=10., verbose=False, tree_file=None,
+                 lazy=False, index_keys=None, **kwargs):
         """
         Returns
         -------
@@ -46,8 +74,22 @@ class QueryCatalog(object):
         """
         # Init
         self.verbose = verbose
+        self.hdf = hdf
+        self._sky_index = None
+        self._group_index = None
+        self._coord_tree = None
+        self._coords = None
+        self.tree_file = tree_file
+        self.lazy = lazy
         # Load catalog
         self.load_cat(hdf, **kwargs)
+        # Column indexes
+        self.indexes = ColumnIndexes(self.cat_column, keys=[self.idkey])
+        if INDEX_GROUP+'/columns' in hdf:
+            self.indexes.load(hdf[INDEX_GROUP+'/columns'])
+        if index_keys is not None:
+            for key in index_keys:
+                self.indexes.add(key)
         # Setup
         self.setup()
 
@@ -66,14 +108,20 @@ class QueryCatalog(object):
         """
         import json
         # Catalog and attributes
-        self.cat = Table(hdf['catalog'].value)
+        self.nsource = hdf['catalog'].shape[0]
+        self.cat_keys = list(hdf['catalog'].dtype.names)
+        self._cat_columns = {}
+        if self.lazy:
+            self._cat = None
+        else:
+            self._cat = Table(hdf['catalog'][()])
         self.cat_attr = {}
         for key in hdf['catalog'].attrs.keys():
             self.cat_attr[key] = spdbu.hdf_decode(hdf['catalog'].attrs[key])
         # Set ID key
         self.idkey = idkey
         if idkey is None:
-            for key in self.cat.keys():
+            for key in self.cat_keys:
                 if 'ID' in key:
                     if self.idkey is not None:
                         raise ValueError("Two keys with ID in them.  You must specify idkey directly.")
@@ -107,15 +155,15 @@ class QueryCatalog(object):
             ncoord = 1
         else:
             ncoord = coords.shape[0]
-        matched_cat = Table(np.repeat(np.zeros_like(self.cat[0]), ncoord))
+        matched_cat = self.empty_cat(ncoord)
         # Grab IDs
         IDs = self.match_coord(coords, toler=toler, **kwargs)
 
         # Find rows in catalog
-        rows = match_ids(IDs, self.cat[self.idkey], require_in_match=False)
+        rows = self.match_ids(IDs, require_in_match=False)
         # Fill
         gd_rows = rows >= 0
-        matched_cat[np.where(gd_rows)] = self.cat[rows[gd_rows]]
+        matched_cat[np.where(gd_rows)] = self.cat_rows(rows[gd_rows])
         # Null the rest
         matched_cat[self.idkey][np.where(~gd_rows)] = IDs[~gd_rows]
         # Return
@@ -135,9 +183,9 @@ class QueryCatalog(object):
 
         """
         # Find rows in catalog
-        rows = match_ids(IDs, self.cat[self.idkey], require_in_match=True)
+        rows = self.match_ids(IDs, require_in_match=True)
         # Fill
-        matched_cat = self.cat[rows]
+        matched_cat = self.cat_rows(rows)
         # Return
         return matched_cat
 
@@ -157,12 +205,9 @@ class QueryCatalog(object):
 
         """
         # Find rows in catalog
-        cat_rows = match_ids(IDs, self.cat[self.idkey].data)
-        # Flags
-        sflag = self.group_dict[group]
-        flags = self.cat['flag_group'][cat_rows]
-        # Query on binary
-        query = (flags % (sflag*2)) >= sflag
+        cat_rows = self.match_ids(IDs)
+        # Query the group bitmap
+        query = self.group_index.contains(group, cat_rows)
         # Answer
         answer = np.sum(query) == IDs.size
         # Return
@@ -191,7 +236,7 @@ class QueryCatalog(object):
 
         """
         # Catalog
-        ids = self.radial_search(coord, tol, **kwargs)
+        _, _, ids = self.query_position(coord, tol, verbose=False, **kwargs)
         if len(ids) == 0:
             warnings.warn("No sources found at your coordinate within tol={:g}.  Returning None".format(tol))
             #return None, None
@@ -232,28 +277,64 @@ class QueryCatalog(object):
           True/False for ID within group(s)
           Mainly useful if user inputs a set of IDs
         """
-        # Init
-        ngroup = len(groups)
+        # Intersection (or union) of the group bitmaps
         if IDs is None:
-            IDs = self.cat[self.idkey].data
-        # Flags
-        cat_rows = match_ids(IDs, self.cat[self.idkey].data, require_in_match=True)
-        fs = self.cat['flag_group'][cat_rows].data
-        msk = np.zeros_like(fs).astype(int)
-        for group in groups:
-            flag = self.group_dict[group]
-            # In the group?
-            query = (fs % (flag*2)) >= flag
-            msk[query] += 1
-        if in_all:
-            good = msk == ngroup
+            IDs = self.cat_column(self.idkey)
+            good = self.group_index.select(groups, in_all=in_all)
         else:
-            good = msk >= 1
+            cat_rows = self.match_ids(IDs, require_in_match=True)
+            good = self.group_index.contains(groups, cat_rows, in_all=in_all)
         gdIDs = IDs[good]
         # Return
         return gdIDs, good
 
 
+    def match_ids(self, IDs, require_in_match=True):
+        """ Match input IDs to the rows of the catalog
+        Same as cat_utils.match_ids but uses the (cached) index of the
+        ID column instead of sorting it on every call
+
+        Parameters
+        ----------
+        IDs : ndarray
+        require_in_match : bool, optional
+          Require that each of the input IDs occurs in the catalog
+
+        Returns
+        -------
+        rows : ndarray
+          Rows in the catalog that match to IDs, aligned
+          -1 if there is no match
+        """
+        return self.indexes.get(self.idkey).match(IDs, require_in_match=require_in_match)
+
+    def match_coord(self, coords, toler=0.5*u.arcsec, verbose=True, **kwargs):
+        """ Match input coordinates to the catalog within a tolerance
+
+        Parameters
+        ----------
+        coords : SkyCoord
+          Single or array
+        toler : Angle or Quantity, optional
+        verbose : bool, optional
+
+        Returns
+        -------
+        IDs : int ndarray
+          ID values of the closest source, aligned with coords
+          -1 if there is no match within toler
+        """
+        # Checks
+        if not isinstance(toler, (Angle, Quantity)):
+            raise IOError("Input radius must be an Angle type, e.g. 10.*u.arcsec")
+        # Match
+        idx, d2d = self.coord_tree.match(coords)
+        IDs = self.cat_column(self.idkey)[idx]
+        IDs[d2d > toler] = -1
+        if verbose:
+            print("Your search yielded {:d} matches from {:d} input coordinates".format(np.sum(IDs >= 0), IDs.size))
+        return IDs
+
     def pairs(self, sep, dv):
         """ Generate a pair catalog
         Parameters
@@ -272,18 +353,18 @@ class QueryCatalog(object):
         if not isinstance(dv, (Quantity)):
             raise IOError("Input velocity must be a quantity, e.g. u.km/u.s")
         # Match
-        idx, d2d, d3d = match_coordinates_sky(self.coords, self.coords, nthneighbor=2)
+        idx, d2d = self.coord_tree.match(self.coords, nthneighbor=2)
         close = d2d < sep
         # Cut on redshift
         if dv > 0.:  # Desire projected pairs
-            zem1 = self.cat['zem'][close]
-            zem2 = self.cat['zem'][idx[close]]
+            zem1 = self.cat_column('zem')[close]
+            zem2 = self.cat_column('zem')[idx[close]]
             dv12 = ltu.dv_from_z(zem1,zem2)
             gdz = np.abs(dv12) > dv
             # f/g and b/g
             izfg = dv12[gdz] < 0*u.km/u.s
-            ID_fg = self.cat[self.idkey][close][gdz][izfg]
-            ID_bg = self.cat[self.idkey][idx[close]][gdz][izfg]
+            ID_fg = self.cat_column(self.idkey)[close][gdz][izfg]
+            ID_bg = self.cat_column(self.idkey)[idx[close]][gdz][izfg]
         else:
             pdb.set_trace()
         # Reload
@@ -319,9 +400,6 @@ class QueryCatalog(object):
         IDs : int ndarray
           Array of IDKEY values of the matches
         """
-        # Init
-        if cat is None:
-            cat = self.cat
         #reload(spdbu)
         # Copy in case we need to add group search
         qdict = idict.copy()
@@ -337,6 +415,7 @@ class QueryCatalog(object):
         if groups is not None:
             # Purge
             purge_flag_group(idict)
+        if (groups is not None) and (cat is not None):
             # Generate flag_group
             fgroups = []
             for group in groups:
@@ -351,6 +430,12 @@ class QueryCatalog(object):
             idict[key] = fgroups
 
         # Query
+        if cat is None:  # Full catalog;  use the indexes and read only the columns needed
+            plan = spdbu.compile_query(idict, self.cat_keys, tbl_name='catalog')
+            matches = spdbu.run_query(plan, self.nsource, self.cat_column, indexes=self.indexes)
+            if groups is not None:  # Group bitmaps
+                matches &= self.group_index.select(groups, in_all=in_all_groups)
+            return matches, self.cat_rows(np.where(matches)[0]), self.cat_column(self.idkey)[matches]
         matches = spdbu.query_table(cat, idict, tbl_name='catalog')
 
         # Return
@@ -396,29 +481,30 @@ class QueryCatalog(object):
             raise IOError("Input radius must be an Angle type, e.g. 10.*u.arcsec")
         # Convert to SkyCoord
         coord = ltu.radec_to_coord(inp)
-        # Separation
-        sep = coord.separation(self.coords)
-
-        # Match
-        matches = sep < radius
+        # Candidate rows from the sky index (ordered by row)
+        rows, sep = self.sky_index.query_radius(coord, radius)
 
-        # Query dict?
-        if (query_dict is not None) or (groups is not None):
+        # Query dict? -- Performed on the cut of the catalog
+        if ((query_dict is not None) or (groups is not None)) and (rows.size > 0):
             if query_dict is None:
                 query_dict = {}
-            qmatches, _, _ = self.query_dict(query_dict, groups=groups, **kwargs)
-            matches &= qmatches
+            qmatches, _, _ = self.query_dict(query_dict, groups=groups,
+                                             cat=self.cat_rows(rows), **kwargs)
+            rows, sep = rows[qmatches], sep[qmatches]
+        # Match
+        matches = np.zeros(self.nsource, dtype=bool)
+        matches[rows] = True
         if verbose:
-            print("Your search yielded {:d} match[es] within radius={:g}".format(np.sum(matches), radius))
+            print("Your search yielded {:d} match[es] within radius={:g}".format(rows.size, radius))
 
         # Sort by separation
-        asort = np.argsort(sep[matches])
+        asort = np.argsort(sep)
         if max_match is not None:
             imax = min(asort.size, max_match)
             asort = asort[:imax]
 
         # Return
-        return matches, self.cat[matches][asort], self.cat[self.idkey][matches].data[asort]
+        return matches, self.cat_rows(rows[asort]), self.cat_column(self.idkey)[rows[asort]]
 
     def query_coords(self, coords, groups=None, toler=0.5*u.arcsec, query_dict=None,
                      verbose=True, **kwargs):
@@ -457,12 +543,8 @@ class QueryCatalog(object):
         if not isinstance(toler, (Angle, Quantity)):
             raise IOError("Input radius must be an Angle type, e.g. 10.*u.arcsec")
         # Match
-        idx, d2d, d3d = match_coordinates_sky(coords, self.coords, nthneighbor=1)
-        if len(d2d) == 1:  # Annoying array/scalar bit
-            IDs = np.array([self.cat[self.idkey][idx]])
-            idx = np.array([int(idx)])
-        else:
-            IDs = self.cat[self.idkey][idx].data
+        idx, d2d = self.coord_tree.match(coords)
+        IDs = self.cat_column(self.idkey)[idx]
         coord_matches = d2d <= toler
         if np.sum(coord_matches) > 0:
             # Query dict or groups? -- Performed on a cut of the full catalog
@@ -470,7 +552,7 @@ class QueryCatalog(object):
                 if query_dict is None:
                     query_dict = {}
                 qmatches, _, _ = self.query_dict(query_dict, groups=groups,
-                                                 cat=self.cat[idx[coord_matches]], **kwargs)
+                                                 cat=self.cat_rows(idx[coord_matches]), **kwargs)
                 # Eliminated bad ones
                 badq = np.where(coord_matches)[0][~qmatches]
                 IDs[badq] = -2
@@ -480,8 +562,8 @@ class QueryCatalog(object):
         if verbose:
             print("Your search yielded {:d} matches from {:d} input coordinates".format(np.sum(matches), IDs.size))
         # Matched catalog
-        matched_cat = Table(np.repeat(np.zeros_like(self.cat[0]), len(IDs)))
-        matched_cat[np.where(matches)] = self.cat[idx[matches]]
+        matched_cat = self.empty_cat(len(IDs))
+        matched_cat[np.where(matches)] = self.cat_rows(idx[matches])
         matched_cat[self.idkey][np.where(~matches)] = IDs[~matches]
         # Return
         return matches, matched_cat, IDs
@@ -532,19 +614,164 @@ class QueryCatalog(object):
             print("    {:s}: {:d}".format(group, self.group_dict[group]))
             #print("    {:s}: {:d}".format(survey, idefs.get_survey_dict()[survey]))
 
+    @property
+    def sky_index(self):
+        """ Positional index of the catalog
+        Read from the DB file or built (once) from the catalog RA/DEC
+        """
+        if self._sky_index is None:
+            self._sky_index = SkyIndex.from_hdf(self.hdf, in_memory=not self.lazy)
+            if self._sky_index is None:
+                if self.verbose:
+                    print("No sky index in the DB file.  Building one in memory")
+                self._sky_index = SkyIndex.from_radec(self.cat_column('RA'), self.cat_column('DEC'))
+            elif len(self._sky_index) != self.nsource:
+                raise ValueError("Sky index in the DB file does not match the catalog")
+        return self._sky_index
+
+    @property
+    def group_index(self):
+        """ Group membership bitmaps of the catalog
+        Read from the DB file or built (as needed) from flag_group
+        """
+        if self._group_index is None:
+            get_flags = lambda: self.cat_column('flag_group')
+            self._group_index = GroupIndex.from_hdf(self.hdf, group_dict=self.group_dict,
+                                                    get_flags=get_flags)
+            if self._group_index is None:
+                self._group_index = GroupIndex(self.nsource, group_dict=self.group_dict,
+                                               get_flags=get_flags)
+            elif self._group_index.nrow != self.nsource:
+                raise ValueError("Group index in the DB file does not match the catalog")
+        return self._group_index
+
+    @property
+    def coord_tree(self):
+        """ KD-tree of the catalog positions
+        Loaded from the sidecar file (if any) or built once from the catalog
+        """
+        if self._coord_tree is None:
+            key = dict(CREATION_DATE=str(self.cat_attr.get('CREATION_DATE')),
+                       VERSION=str(self.cat_attr.get('VERSION')), NSOURCE=self.nsource)
+            # Sidecar file?
+            tree_file = self.tree_file
+            if tree_file is True:
+                tree_file = self.hdf.filename+'.kdtree.npz'
+            if tree_file:
+                self._coord_tree = CoordTree.load(tree_file, key=key)
+            if self._coord_tree is None:
+                self._coord_tree = CoordTree.from_radec(self.cat_column('RA'), self.cat_column('DEC'), key=key)
+                if tree_file:
+                    try:
+                        self._coord_tree.save(tree_file)
+                    except (IOError, OSError):
+                        warnings.warn("Unable to write KD-tree to {:s}".format(tree_file))
+        return self._coord_tree
+
+    @property
+    def cat(self):
+        """ The full catalog as a Table
+        Read from the DB file on first access if lazy=True
+        """
+        if self._cat is None:
+            if self.verbose:
+                print("Loading the full catalog")
+            self._cat = Table(self.hdf['catalog'][()])
+            self._cat_columns = {}
+            self.setup()
+        return self._cat
+
+    @property
+    def coords(self):
+        """ SkyCoord of the catalog, generated on first use
+        """
+        if self._coords is None:
+            self._coords = SkyCoord(ra=self.cat_column('RA'), dec=self.cat_column('DEC'), unit='deg')
+        return self._coords
+
+    def cat_column(self, key):
+        """ Return one column of the catalog as an ndarray
+        Read (and cached) column-wise from the DB file if the
+        full catalog has not been loaded
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        column : ndarray
+        """
+        if self._cat is not None:
+            return self._cat[key].data
+        if key not in self._cat_columns.keys():
+            self._cat_columns[key] = self.hdf['catalog'][key]
+        return self._cat_columns[key]
+
+    def cat_rows(self, rows):
+        """ Return a set of rows from the catalog as a Table
+        without loading the full catalog if lazy=True
+
+        Parameters
+        ----------
+        rows : int ndarray
+
+        Returns
+        -------
+        sub_cat : Table
+          Aligned with the input rows
+        """
+        if self._cat is not None:
+            return self._cat[rows]
+        rows = np.asarray(rows, dtype=int)
+        # h5py requires increasing, unique indices
+        urows, inv = np.unique(rows, return_inverse=True)
+        if urows.size == 0:
+            return self.empty_cat(0)
+        data = self.hdf['catalog'][urows.tolist()]
+        return self.format_cat(Table(data[inv]))
+
+    def empty_cat(self, nrow):
+        """ Generate an empty (zero-filled) catalog Table
+
+        Parameters
+        ----------
+        nrow : int
+
+        Returns
+        -------
+        empty : Table
+        """
+        return self.format_cat(Table(np.zeros(nrow, dtype=self.hdf['catalog'].dtype)))
+
+    def format_cat(self, tbl):
+        """ Apply the standard formatting to a catalog Table
+
+        Parameters
+        ----------
+        tbl : Table
+
+        Returns
+        -------
+        tbl : Table
+          Same object, formatted in place
+        """
+        tbl['RA'].format = '8.4f'
+        tbl['DEC'].format = '8.4f'
+        tbl['zem'].format = '6.3f'
+        tbl['sig_zem'].format = '5.3f'
+        return tbl
+
     def setup(self):
-        """ Set up a few things, e.g. SkyCoord for the catalog
+        """ Set up a few things, e.g. formatting of the catalog
         Returns
         -------
 
         """
-        # SkyCoord
-        self.coords = SkyCoord(ra=self.cat['RA'], dec=self.cat['DEC'], unit='deg')
+        if self._cat is None:
+            return
         # Formatting the Table
-        self.cat['RA'].format = '8.4f'
-        self.cat['DEC'].format = '8.4f'
-        self.cat['zem'].format = '6.3f'
-        self.cat['sig_zem'].format = '5.3f'
+        self.format_cat(self._cat)
 
 
     def groups_containing_IDs(self, IDs, igroup=None):
@@ -569,13 +796,11 @@ class QueryCatalog(object):
         if igroup is None:
             igroup = self.groups
         #
-        cat_rows = match_ids(IDs, self.cat[self.idkey])
-        flags = self.cat['flag_group'][cat_rows]
+        cat_rows = self.match_ids(IDs)
         gd_groups = []
         for group in igroup:
-            sflag = self.group_dict[group]
             # In the group?
-            query = (flags & sflag).astype(bool)
+            query = self.group_index.contains(group, cat_rows)
             if np.sum(query) == nIDs:
                 gd_groups.append(group)
         # Return
@@ -583,7 +808,7 @@ class QueryCatalog(object):
 
     def __repr__(self):
         txt = '<{:s}:  Catalog has {:d} sources\n'.format(self.__class__.__name__,
-                                            len(self.cat))
+                                            self.nsource)
         # Surveys
         txt += '   Loaded groups are {} \n'.format(self.groups)
         txt += '>'
@@ -84,12 +84,12 @@ def main(pargs):
     # List datasets
     nspec = 0
     for key in hdf.keys():
-        if key == 'catalog':
+        if key in ['catalog', 'catalog_index']:
             continue
         print("Dataset: {:s}".format(key))
         # Spectra
         try:
-            nspec += hdf[key]['spec'].size
+            nspec += hdf[key]['meta'].size
         except:
             pass
 
@@ -24,6 +24,13 @@ def parser(options=None):
     parser.add_argument("--version", type=str, help="Version of the DB; default is `v00`")
     parser.add_argument("--publisher", type=str, help="Publisher of the DB; default is `Unknown`")
     parser.add_argument("--fname", default=False, action="store_true", help="Parse RA/DEC from filename?")
+    parser.add_argument("--layout", type=str, default='padded', help="Storage of the spectra: padded (default) or flat")
+    parser.add_argument("--wave_encoding", default=False, action="store_true", help="Store linear and log-linear wavelength grids as solutions?")
+    parser.add_argument("--codec", type=str, default='gzip', help="Compression of the spectra: gzip (default), gzip-shuffle, lzf, lzf-shuffle, blosc, zstd")
+    parser.add_argument("--chunk_rows", type=int, help="Number of spectra per HDF5 chunk")
+    parser.add_argument("--contiguous", default=False, action="store_true", help="Write the spectra contiguous and uncompressed (for memory mapping)?")
+    parser.add_argument("--workers", type=int, help="Number of processes reading the spectral files")
+    parser.add_argument("--append", default=False, action="store_true", help="Add tree_path as a new group to the existing DB in outfile?  tree_path is then a single branch")
 
     if options is None:
         pargs = parser.parse_args()
@@ -43,6 +50,7 @@ def main(pargs):
 
     """
     import glob
+    import os
     from astropy.table import Table
     from specdb.build import privatedb as pbuild
 
@@ -60,6 +68,8 @@ def main(pargs):
     else:
         # Search for a z table
         ztbl_files = glob.glob(tree+'/*_ztbl*')
+        if pargs.append and (len(ztbl_files) == 0):  # Top of the tree
+            ztbl_files = glob.glob(os.path.dirname(os.path.normpath(tree))+'/*_ztbl*')
         if len(ztbl_files) == 1:
             print("Reading redshift table {:s}".format(ztbl_files[0]))
             iztbl = Table.read(ztbl_files[0])
@@ -68,6 +78,15 @@ def main(pargs):
         else:
             raise IOError("Multiple redshift tables found in your tree")
 
+    # Append
+    if pargs.append:
+        pbuild.append_group(tree, pargs.outfile, iztbl, version=pargs.version,
+                            fname=pargs.fname, layout=pargs.layout,
+                            wave_encoding=pargs.wave_encoding, codec=pargs.codec,
+                            chunk_rows=pargs.chunk_rows, contiguous=pargs.contiguous,
+                            workers=pargs.workers)
+        return
+
     # version
     if pargs.version is None:
         version = 'v00'
@@ -81,7 +100,10 @@ def main(pargs):
 
     # Run
     pbuild.mk_db(pargs.db_name, tree, pargs.outfile, iztbl,
-                 fname=pargs.fname, version=version, publisher=publisher)
+                 fname=pargs.fname, version=version, publisher=publisher,
+                 layout=pargs.layout, wave_encoding=pargs.wave_encoding,
+                 codec=pargs.codec, chunk_rows=pargs.chunk_rows,
+                 contiguous=pargs.contiguous, workers=pargs.workers)
 
 ##
 if __name__ == '__main__':
@@ -0,0 +1,389 @@
+""" Module for the sky (positional) index of the source catalog
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import pdb
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord, Angle
+
+# Name of the HDF5 group holding the catalog indices
+INDEX_GROUP = 'catalog_index'
+
+
+class SkyIndex(object):
+    """ A declination-zone index of the catalog positions
+
+    The sky is cut into zones of constant declination height.
+    Within a zone the sources are sorted by RA so that a cone
+    search only needs a binary search per zone followed by an
+    exact separation test on the few candidate rows.
+
+    The arrays may be numpy arrays or h5py Datasets;  the latter
+    allows the index to be queried straight from the DB file.
+
+    Parameters
+    ----------
+    rows : ndarray
+      Catalog rows, sorted by zone and then RA
+    ra : ndarray
+      RA values (deg) aligned with rows
+    dec : ndarray
+      DEC values (deg) aligned with rows
+    zone_start : ndarray
+      Index into rows of the first entry for each zone; length nzone+1
+    zone_height : float
+      Height of a zone in deg
+
+    Attributes
+    ----------
+    nzone : int
+    """
+
+    def __init__(self, rows, ra, dec, zone_start, zone_height):
+        self.rows = rows
+        self.ra = ra
+        self.dec = dec
+        self.zone_start = np.asarray(zone_start)
+        self.zone_height = float(zone_height)
+        self.nzone = self.zone_start.size - 1
+
+    @classmethod
+    def from_radec(cls, ra, dec, zone_height=0.1):
+        """ Build the index from RA/DEC arrays
+
+        Parameters
+        ----------
+        ra : ndarray
+          deg
+        dec : ndarray
+          deg
+        zone_height : float, optional
+          deg
+
+        Returns
+        -------
+        SkyIndex
+
+        """
+        ra = np.asarray(ra, dtype=float) % 360.
+        dec = np.asarray(dec, dtype=float)
+        nzone = int(np.ceil(180. / zone_height))
+        zones = zone_of_dec(dec, zone_height, nzone)
+        # Sort by zone then RA
+        rows = np.lexsort((ra, zones))
+        zone_start = np.searchsorted(zones[rows], np.arange(nzone+1))
+        return cls(rows, ra[rows], dec[rows], zone_start, zone_height)
+
+    @classmethod
+    def from_hdf(cls, hdf, in_memory=True):
+        """ Load the index from a DB file
+
+        Parameters
+        ----------
+        hdf : h5py.File
+        in_memory : bool, optional
+          Read the arrays into memory.  Otherwise they are
+          sliced from the file on each query
+
+        Returns
+        -------
+        SkyIndex or None
+          None if the DB file has no sky index
+
+        """
+        try:
+            sgrp = hdf[INDEX_GROUP+'/sky']
+        except KeyError:
+            return None
+        if in_memory:
+            rows, ra, dec = sgrp['rows'][()], sgrp['ra'][()], sgrp['dec'][()]
+        else:
+            rows, ra, dec = sgrp['rows'], sgrp['ra'], sgrp['dec']
+        return cls(rows, ra, dec, sgrp['zone_start'][()], sgrp.attrs['ZONE_HEIGHT'])
+
+    def write(self, hdf):
+        """ Write the index to a DB file
+
+        Parameters
+        ----------
+        hdf : h5py.File
+          Must be writeable
+        """
+        grp = hdf.require_group(INDEX_GROUP)
+        if 'sky' in grp.keys():
+            del grp['sky']
+        sgrp = grp.create_group('sky')
+        sgrp['rows'] = np.asarray(self.rows[()])
+        sgrp['ra'] = np.asarray(self.ra[()])
+        sgrp['dec'] = np.asarray(self.dec[()])
+        sgrp['zone_start'] = self.zone_start
+        sgrp.attrs['ZONE_HEIGHT'] = self.zone_height
+
+    def candidates(self, ra0, dec0, radius):
+        """ Return the catalog rows of all sources that may lie
+        within radius of (ra0, dec0).  A superset of the true matches.
+
+        Parameters
+        ----------
+        ra0 : float
+          deg
+        dec0 : float
+          deg
+        radius : float
+          deg
+
+        Returns
+        -------
+        rows : int ndarray
+        ra : ndarray
+        dec : ndarray
+          Positions of the candidates
+        """
+        ra0 = ra0 % 360.
+        z0 = zone_of_dec(dec0-radius, self.zone_height, self.nzone)
+        z1 = zone_of_dec(dec0+radius, self.zone_height, self.nzone)
+        alpha = ra_window(dec0, radius)
+        # RA windows, allowing for the wrap at 0/360
+        if alpha >= 180.:
+            windows = [(0., 360.)]
+        else:
+            lo, hi = ra0 - alpha, ra0 + alpha
+            if lo < 0.:
+                windows = [(lo+360., 360.), (0., hi)]
+            elif hi >= 360.:
+                windows = [(lo, 360.), (0., hi-360.)]
+            else:
+                windows = [(lo, hi)]
+        # Loop on zones
+        all_rows, all_ra, all_dec = [], [], []
+        for zone in range(z0, z1+1):
+            i0, i1 = int(self.zone_start[zone]), int(self.zone_start[zone+1])
+            if i1 == i0:
+                continue
+            zra = self.ra[i0:i1]
+            for lo, hi in windows:
+                j0 = np.searchsorted(zra, lo, side='left')
+                j1 = np.searchsorted(zra, hi, side='right')
+                if j1 > j0:
+                    all_rows.append(self.rows[i0+j0:i0+j1])
+                    all_ra.append(zra[j0:j1])
+                    all_dec.append(self.dec[i0+j0:i0+j1])
+        if len(all_rows) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+        return np.concatenate(all_rows), np.concatenate(all_ra), np.concatenate(all_dec)
+
+    def query_radius(self, coord, radius):
+        """ Find all catalog rows within radius of the input coordinate
+
+        Parameters
+        ----------
+        coord : SkyCoord
+          Single coordinate
+        radius : Angle or Quantity
+
+        Returns
+        -------
+        rows : int ndarray
+          Catalog rows of the matches, sorted by row
+        sep : Angle
+          Separations aligned with rows
+        """
+        radius = Angle(radius)
+        coord = coord.icrs
+        rows, ra, dec = self.candidates(coord.ra.deg, coord.dec.deg, radius.to('deg').value)
+        srt = np.argsort(rows)
+        rows, ra, dec = rows[srt], ra[srt], dec[srt]
+        sep = coord.separation(SkyCoord(ra=ra, dec=dec, unit='deg'))
+        gd = sep < radius
+        return rows[gd], sep[gd]
+
+    def __len__(self):
+        return int(self.zone_start[-1])
+
+    def __repr__(self):
+        txt = '<{:s}: nsource={:d}, nzone={:d}, zone_height={:g} deg>'.format(
+            self.__class__.__name__, len(self), self.nzone, self.zone_height)
+        return (txt)
+
+
+def ra_window(dec0, radius):
+    """ Half-width in RA (deg) of the band that contains a circle
+    of a given radius (see Gray et al. 2006, the Zones Algorithm)
+
+    Parameters
+    ----------
+    dec0 : float
+      deg
+    radius : float
+      deg
+
+    Returns
+    -------
+    alpha : float
+      deg;  180 if the circle touches a pole
+    """
+    if np.abs(dec0) + radius >= 89.9:
+        return 180.
+    r = np.radians(radius)
+    d0 = np.radians(dec0)
+    alpha = np.degrees(np.arctan(np.sin(r) / np.sqrt(np.abs(np.cos(d0-r)*np.cos(d0+r)))))
+    # Pad for round-off
+    return min(alpha*1.0001 + 1e-9, 180.)
+
+
+def zone_of_dec(dec, zone_height, nzone):
+    """ Zone number for DEC value(s)
+
+    Parameters
+    ----------
+    dec : float or ndarray
+      deg
+    zone_height : float
+      deg
+    nzone : int
+
+    Returns
+    -------
+    zone : int or int ndarray
+    """
+    zone = np.floor((np.asarray(dec) + 90.) / zone_height).astype(int)
+    zone = np.clip(zone, 0, nzone-1)
+    if zone.ndim == 0:
+        return int(zone)
+    return zone
+
+
+class CoordTree(object):
+    """ A KD-tree of the catalog positions, built on 3-D unit vectors
+
+    Built once per catalog and reused for all coordinate matching.
+    Its unit vectors may be saved to a sidecar .npz file keyed by
+    the CREATION_DATE and VERSION of the DB;  the tree is rebuilt
+    from them on loading.
+
+    Parameters
+    ----------
+    tree : scipy.spatial.cKDTree
+    key : dict, optional
+      Identifies the DB the tree was built from
+    """
+
+    def __init__(self, tree, key=None):
+        self.tree = tree
+        self.key = key
+
+    @classmethod
+    def from_radec(cls, ra, dec, key=None):
+        """ Build the tree from RA/DEC arrays
+
+        Parameters
+        ----------
+        ra : ndarray
+          deg
+        dec : ndarray
+          deg
+        key : dict, optional
+
+        Returns
+        -------
+        CoordTree
+
+        """
+        from scipy.spatial import cKDTree
+        xyz = radec_to_xyz(ra, dec)
+        return cls(cKDTree(xyz), key=key)
+
+    @classmethod
+    def load(cls, tree_file, key=None):
+        """ Load a tree from a sidecar file
+        Only arrays are read (no pickles), so the file need not be trusted
+
+        Parameters
+        ----------
+        tree_file : str
+        key : dict, optional
+          If provided, it must match the key saved with the tree
+
+        Returns
+        -------
+        CoordTree or None
+          None if the file is missing or was built for another DB
+        """
+        import json
+        from scipy.spatial import cKDTree
+        try:
+            with np.load(tree_file, allow_pickle=False) as npz:
+                tkey = json.loads(str(npz['key']))
+                xyz = npz['xyz']
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        if (key is not None) and (tkey != key):
+            return None
+        if (xyz.ndim != 2) or (xyz.shape[1] != 3):
+            return None
+        return cls(cKDTree(xyz), key=tkey)
+
+    def save(self, tree_file):
+        """ Save the unit vectors of the tree to a sidecar .npz file
+
+        Parameters
+        ----------
+        tree_file : str
+        """
+        import json
+        with open(tree_file, 'wb') as f:  # np.savez would append .npz to the name
+            np.savez(f, xyz=self.tree.data, key=np.array(json.dumps(self.key)))
+
+    def match(self, coords, nthneighbor=1):
+        """ Find the nth nearest neighbor in the catalog to each input coordinate
+        Same conventions as astropy.coordinates.match_coordinates_sky
+
+        Parameters
+        ----------
+        coords : SkyCoord
+          Single or array
+        nthneighbor : int, optional
+
+        Returns
+        -------
+        idx : int ndarray
+          Catalog rows;  always 1-D
+        d2d : Angle
+          On-sky separations;  always 1-D
+        """
+        coords = coords.icrs
+        xyz = radec_to_xyz(np.atleast_1d(coords.ra.deg), np.atleast_1d(coords.dec.deg))
+        dist, idx = self.tree.query(xyz, k=nthneighbor)
+        if nthneighbor > 1:
+            dist, idx = dist[:, -1], idx[:, -1]
+        d2d = Angle(np.degrees(2*np.arcsin(np.clip(dist/2., 0., 1.))), unit='deg')
+        return idx, d2d
+
+    def __len__(self):
+        return self.tree.n
+
+    def __repr__(self):
+        txt = '<{:s}: nsource={:d}>'.format(self.__class__.__name__, len(self))
+        return (txt)
+
+
+def radec_to_xyz(ra, dec):
+    """ Convert RA/DEC to 3-D unit vectors
+
+    Parameters
+    ----------
+    ra : ndarray
+      deg
+    dec : ndarray
+      deg
+
+    Returns
+    -------
+    xyz : ndarray (N,3)
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cosd = np.cos(dec)
+    return np.array([cosd*np.cos(ra), cosd*np.sin(ra), np.sin(dec)]).T
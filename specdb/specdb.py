@@ -13,6 +13,9 @@ from astropy.table import Table, vstack
 from specdb import utils as spdbu
 from specdb.query_catalog import QueryCatalog
 from specdb.interface_group import InterfaceGroup
+from specdb.spectra_index import SpectraIndex
+from specdb.column_index import ranges_to_indices
+from specdb.group_utils import MemoryBudget
 
 try:
     basestring
@@ -27,14 +30,38 @@ class SpecDB(object):
     ----------
     skip_test : bool, optional
       Skip tests?  Highly *not* recommended
+    lazy : bool, optional
+      Passed to QueryCatalog;  read the catalog only as needed
+    meta_columns : list, optional
+      Passed to InterfaceGroup;  only read these columns of the
+      meta data (others are read as needed by the queries)
+    cache_Gb : float, optional
+      Passed to InterfaceGroup;  size of the cache of spectra for each group.
+      Off by default
+    memmap : bool, optional
+      Passed to InterfaceGroup;  memory map the spectra of contiguous,
+      uncompressed groups
+    maximum_ram : float, optional
+      Budget for the spectra handed out by all groups, in Gb
+    rdcc_nbytes : int, optional
+      Size of the HDF5 chunk cache (per dataset) of decompressed chunks;
+      the h5py default (1 Mb) holds less than one chunk of spectra
+    rdcc_nslots : int, optional
+      Number of slots in the HDF5 chunk cache
 
     Attributes
     ----------
     qcat : QueryCatalog
+    cat : Table
+      The source catalog (from qcat)
+    spectra_index : SpectraIndex
+      Spectra of each source (None if not in the DB file)
     idb : InterfaceDB
     """
 
-    def __init__(self, skip_test=True, db_file=None, verbose=False, **kwargs):
+    def __init__(self, skip_test=True, db_file=None, verbose=False, meta_columns=None,
+                 cache_Gb=0., rdcc_nbytes=None, rdcc_nslots=None, memmap=False,
+                 maximum_ram=10., **kwargs):
         """
         """
         if db_file is None:
@@ -45,16 +72,20 @@ class SpecDB(object):
                               "variable or directly provide the db_file")
         # Init
         self.verbose = verbose
-        self.open_db(db_file)
+        self.meta_columns = meta_columns
+        self.cache_Gb = cache_Gb
+        self.memmap = memmap
+        self.budget = MemoryBudget(maximum_ram)
+        self.open_db(db_file, rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
         # Catalog
-        self.qcat = QueryCatalog(self.hdf, verbose=self.verbose, **kwargs)
-        self.cat = self.qcat.cat  # For convenience
+        self.qcat = QueryCatalog(self.hdf, maximum_ram=maximum_ram, verbose=self.verbose, **kwargs)
         self.qcat.verbose = verbose
         self.groups = self.qcat.groups
         self.group_dict = self.qcat.group_dict
         self.idkey = self.qcat.idkey
         # Groups
         self._gdict = {}
+        self._spectra_index = None
         # Name, Creation date
         self.name = spdbu.hdf_decode(self.qcat.cat_attr['NAME'])
         print("Database is {:s}".format(self.name))
@@ -62,12 +93,35 @@ class SpecDB(object):
         # Return
         return
 
-    def open_db(self, db_file):
+    @property
+    def spectra_index(self):
+        """ Index of the spectra of each source in every group
+        Read from the DB file;  None if the file has none
+        """
+        if self._spectra_index is None:
+            self._spectra_index = SpectraIndex.from_hdf(self.hdf)
+            if self._spectra_index is None:
+                self._spectra_index = False
+        if self._spectra_index is False:
+            return None
+        return self._spectra_index
+
+    @property
+    def cat(self):
+        """ The source catalog;  for convenience
+        """
+        return self.qcat.cat
+
+    def open_db(self, db_file, rdcc_nbytes=None, rdcc_nslots=None):
         """ Open the DB file
 
         Parameters
         ----------
         db_file : str
+        rdcc_nbytes : int, optional
+          Size of the HDF5 chunk cache
+        rdcc_nslots : int, optional
+          Number of slots in the HDF5 chunk cache
 
         Returns
         -------
@@ -76,11 +130,22 @@ class SpecDB(object):
         #
         if self.verbose:
             print("Using {:s} for the DB file".format(db_file))
-        self.hdf = h5py.File(db_file,'r')
+        # Registers the Blosc and Zstd filters, if the DB was built with them
+        try:
+            import hdf5plugin
+        except ImportError:
+            pass
+        # Chunk cache
+        cache_kwargs = {}
+        if rdcc_nbytes is not None:
+            cache_kwargs['rdcc_nbytes'] = int(rdcc_nbytes)
+        if rdcc_nslots is not None:
+            cache_kwargs['rdcc_nslots'] = int(rdcc_nslots)
+        self.hdf = h5py.File(db_file,'r', **cache_kwargs)
         self.db_file = db_file
 
     def meta_from_coords(self, coords, query_dict=None, groups=None,
-                               first=True, **kwargs):
+                               first=True, masks=False, **kwargs):
         """ Return meta data for an input set of coordinates
         Parameters
         ----------
@@ -91,21 +156,27 @@ class SpecDB(object):
           If provided, the meta data of the groups are searched in the list order
         first : bool, optional
           Only provide the first entry found for the source
+        masks : bool, optional
+          If first=False, return a list of bool arrays instead of offsets
+          (slow for many coordinates)
         kwargs
 
         Returns
         -------
         matches : bool array
           True if the coordinate + query matches in database
-        final_meta : masked Table or list
+        final_meta : masked Table or ndarray or list
           If first=True (default), the method returns a masked Table
           with each row aligned to the input coordinates.  Entries
           that do not match are fully masked.  The entry is the first
           one found (looping over groups).
-          If first=False, this is a list of bool arrays that point to the
-            entries in the stack table (which follows).  This avoids
-             generating N Tables which is very slow
-        stack : Table -- only if first=False
+          If first=False, this is an int array of offsets into the
+            stack table (which follows), which is grouped by input coordinate:
+            the entries of coordinate ii are stack[offsets[ii]:offsets[ii+1]].
+            This avoids generating N Tables which is very slow
+          If first=False and masks=True, this is a list of bool arrays
+            that point to the entries in the stack table (None if no match)
+        stack : Table -- only if first=False;  None if there is no match
         """
         from specdb.cat_utils import match_ids
         # Cut down using source catalog
@@ -147,8 +218,10 @@ class SpecDB(object):
             matches[:] = False
             if first:
                 return matches, None
+            elif masks:
+                return matches, [None]*matches.size, None
             else:
-                return matches, [None]*matches.size
+                return matches, np.zeros(matches.size+1, dtype=int), None
         elif len(meta_list) == 1:
             stack = meta_list[0]
         else:
@@ -173,6 +246,14 @@ class SpecDB(object):
             print("Final query yielded {:d} matches.".format(np.sum(matches)))
             # Return
             return matches, final_meta
+        elif not masks:
+            # Group the stack by input coordinate (stable sort on ID)
+            srt = np.argsort(stack[self.idkey].data, kind='mergesort')
+            stack_IDs = stack[self.idkey].data[srt]
+            i0 = np.searchsorted(stack_IDs, IDs, side='left')
+            nrow = np.where(matches, np.searchsorted(stack_IDs, IDs, side='right') - i0, 0)
+            offsets = np.concatenate([[0], np.cumsum(nrow)])
+            return matches, offsets, stack[srt[ranges_to_indices(i0, i0+nrow)]]
         else:
             final_list = [None]*matches.size
             # Loop on coords
@@ -272,10 +353,19 @@ class SpecDB(object):
         # Init
         if groups is None:
             groups = self.groups
+        # Restrict to the spectra of the input IDs?
+        IDs = qdict.get(self.idkey)
+        group_rows = {}
+        if (self.spectra_index is not None) and (IDs is not None) and (
+                not isinstance(IDs, tuple)):
+            group_rows = self.spectra_index.rows_by_group(IDs)
         # Loop on groups
         all_meta = []
         for group in groups:
-            matches, sub_meta, IDs = self[group].query_meta(qdict, **kwargs)
+            rows = group_rows.get(group)
+            if (rows is not None) and (rows.size == 0):
+                continue
+            matches, sub_meta, IDs_group = self[group].query_meta(qdict, rows=rows, **kwargs)
             if len(sub_meta) > 0:
                 # Add group
                 sub_meta['GROUP'] = str(group)
@@ -290,7 +380,7 @@ class SpecDB(object):
         else:
             return vstack(all_meta)
 
-    def spectra_from_meta(self, meta, debug=False):
+    def spectra_from_meta(self, meta, debug=False, workers=None, processes=None):
         """ Returns one spectrum per row in the input meta data table
         This meta data table should have been generated by a meta query
 
@@ -299,6 +389,10 @@ class SpecDB(object):
         meta : Table
           Must include a column 'GROUP' indicating the group for each row
           This automatically generated by any of the meta query methods
+        workers : int, optional
+          Decompress the spectra in this many threads (gzip compressed groups)
+        processes : int, optional
+          Read the spectra in this many processes;  for very large requests
 
         Returns
         -------
@@ -316,11 +410,19 @@ class SpecDB(object):
         groups = np.unique(meta['GROUP'].data)
         all_spec = []
         sv_rows = []
-        for group in groups:
-            sub_meta = meta['GROUP'] == group
-            sv_rows.append(np.where(sub_meta)[0])
-            # Grab
-            all_spec.append(self[group].spec_from_meta(meta[sub_meta]))
+        pool, process_pool = self.thread_pool(workers), self.process_pool(processes)
+        try:
+            for group in groups:
+                sub_meta = meta['GROUP'] == group
+                sv_rows.append(np.where(sub_meta)[0])
+                # Grab
+                all_spec.append(self[group].spec_from_meta(meta[sub_meta], pool=pool,
+                                                           process_pool=process_pool,
+                                                           processes=processes))
+        finally:
+            for ipool in [pool, process_pool]:
+                if ipool is not None:
+                    ipool.shutdown()
         # Collate
         spec = ltsu.collate(all_spec)
         # Re-order
@@ -330,6 +432,122 @@ class SpecDB(object):
         #
         return spec2
 
+    def iter_spectra(self, meta, batch_size=1000, workers=None, processes=None):
+        """ Iterate over the spectra of an input meta data table in
+        batches, without collating them into one XSpectrum1D
+        Memory is limited to one batch
+
+        Parameters
+        ----------
+        meta : Table
+          Must include a column 'GROUP' indicating the group for each row
+          This automatically generated by any of the meta query methods
+        batch_size : int, optional
+          Number of spectra per batch
+        workers : int, optional
+          Decompress the spectra in this many threads (gzip compressed groups)
+        processes : int, optional
+          Read the spectra in this many processes;  for very large requests
+
+        Returns
+        -------
+        Generator of
+        sub_meta : Table
+          The next batch_size rows of meta (fewer for the last batch)
+        data : ndarray
+          Fields wave, flux, sig (and co, if stored by any of the groups),
+          aligned with sub_meta.  Each is an array of the largest number of
+          pixels in the batch, padded with 0
+        """
+        # Checks
+        if 'GROUP' not in meta.keys():
+            print("Input meta data table must include a GROUP column")
+            print("We suspect yours was not made by a meta query.  Try one")
+            raise IOError("And then try again.")
+        pool, process_pool = self.thread_pool(workers), self.process_pool(processes)
+        try:
+            for i0 in range(0, len(meta), batch_size):
+                sub_meta = meta[i0:i0+batch_size]
+                yield sub_meta, self.grab_batch(sub_meta, pool=pool, process_pool=process_pool,
+                                                processes=processes)
+        finally:
+            for ipool in [pool, process_pool]:
+                if ipool is not None:
+                    ipool.shutdown()
+
+    def grab_batch(self, meta, pool=None, process_pool=None, processes=None):
+        """ Grab the spectral arrays of an input meta data table
+        See iter_spectra
+
+        Parameters
+        ----------
+        meta : Table
+        pool : concurrent.futures.Executor, optional
+        process_pool : concurrent.futures.ProcessPoolExecutor, optional
+        processes : int, optional
+          Number of workers of process_pool
+
+        Returns
+        -------
+        data : ndarray
+          Fields wave, flux, sig (and co), aligned with meta
+        """
+        # Grab, group by group
+        all_data = []
+        for group in np.unique(meta['GROUP'].data):
+            idx = np.where(meta['GROUP'] == group)[0]
+            rows = self[group].groupids_to_rows(meta['GROUP_ID'][idx])
+            data = self[group].grab_data(rows, verbose=False, pool=pool, process_pool=process_pool,
+                                         processes=processes)
+            all_data.append((idx, data))
+        # Fill the batch, in input order
+        npix = max([data['flux'].shape[1] for _, data in all_data])
+        names = ['wave', 'flux', 'sig']
+        if np.any(['co' in data.dtype.names for _, data in all_data]):
+            names.append('co')
+        dtype = [(str(name), 'float64' if name == 'wave' else 'float32', (npix,))
+                 for name in names]
+        batch = np.zeros(len(meta), dtype=dtype)
+        for idx, data in all_data:
+            for name in data.dtype.names:
+                batch[name][idx, :data[name].shape[1]] = data[name]
+        return batch
+
+    def thread_pool(self, workers):
+        """ Pool of threads for decompressing spectra
+
+        Parameters
+        ----------
+        workers : int or None
+
+        Returns
+        -------
+        pool : ThreadPoolExecutor or None
+          None unless workers > 1
+        """
+        if (workers is None) or (workers <= 1):
+            return None
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=int(workers))
+
+    def process_pool(self, processes):
+        """ Pool of processes for reading spectra
+        Each opens the DB file itself;  see group_utils.read_rows_sharded
+
+        Parameters
+        ----------
+        processes : int or None
+
+        Returns
+        -------
+        pool : ProcessPoolExecutor or None
+          None unless processes > 1
+        """
+        if (processes is None) or (processes <= 1):
+            return None
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=int(processes))
+
     def spectra_from_coord(self, inp, tol=0.5*u.arcsec, **kwargs):
         """ Return spectra and meta data from an input coordinate
         Radial search at that location within a small tolerance
@@ -430,12 +648,16 @@ class SpecDB(object):
             if key not in self.groups:
                 raise IOError("Input group={:s} is not in the database".format(key))
             else: # Load
-                self._gdict[key] = InterfaceGroup(self.hdf, key, idkey=self.idkey)
+                self._gdict[key] = InterfaceGroup(self.hdf, key, idkey=self.idkey,
+                                                  meta_columns=self.meta_columns,
+                                                  cache_Gb=self.cache_Gb, memmap=self.memmap,
+                                                  maximum_ram=self.budget.max_nbytes/1e9,
+                                                  budget=self.budget)
                 return self._gdict[key]
 
     def __repr__(self):
         txt = '<{:s}:  specDB_file={:s} with {:d} sources\n'.format(self.__class__.__name__,
-                                            self.db_file, len(self.cat))
+                                            self.db_file, self.qcat.nsource)
         # Surveys
         txt += '   Groups are {} \n'.format(self.groups)
         txt += '>'
@@ -504,7 +726,7 @@ class IgmSpec(SpecDB):
 
     def __repr__(self):
         txt = '<{:s}:  IGM_file={:s} with {:d} sources\n'.format(self.__class__.__name__,
-                                                                 self.db_file, len(self.cat))
+                                                                 self.db_file, self.qcat.nsource)
         # Surveys
         txt += '   Loaded groups are {} \n'.format(self.groups)
         txt += '>'
@@ -561,7 +783,7 @@ class UVQS(SpecDB):
 
     def __repr__(self):
         txt = '<{:s}:  UVQS_file={:s} with {:d} sources\n'.format(self.__class__.__name__,
-                                                                 self.db_file, len(self.cat))
+                                                                 self.db_file, self.qcat.nsource)
         # Surveys
         txt += '   Loaded groups are {} \n'.format(self.groups)
         txt += '>'
@@ -0,0 +1,159 @@
+""" Module for the index of the spectra of each source
+"""
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import numpy as np
+import pdb
+
+from specdb.sky_index import INDEX_GROUP
+from specdb.column_index import ranges_to_indices
+
+
+class SpectraIndex(object):
+    """ An inverted index from source ID to the spectra of the source
+    in every group, stored in compressed sparse row (CSR) form
+
+    The entries of source ids[i] are group[offsets[i]:offsets[i+1]]
+    and row[offsets[i]:offsets[i+1]], sorted by group and then row.
+
+    Parameters
+    ----------
+    ids : int ndarray
+      Sorted, unique source IDs
+    offsets : int ndarray
+      Length ids.size+1
+    group : int ndarray
+      Group of each entry, an index into groups
+    row : int ndarray
+      Row of each entry in the meta data of its group
+    groups : list of str
+      Group names
+    """
+
+    def __init__(self, ids, offsets, group, row, groups):
+        self.ids = ids
+        self.offsets = offsets
+        self.group = group
+        self.row = row
+        self.groups = list(groups)
+
+    @classmethod
+    def from_ids(cls, group_ids, groups):
+        """ Build the index from the ID columns of the meta data
+
+        Parameters
+        ----------
+        group_ids : list of ndarray
+          ID column of the meta data of each group
+        groups : list of str
+          Group names, aligned with group_ids
+
+        Returns
+        -------
+        SpectraIndex
+
+        """
+        if len(group_ids) == 0:
+            return cls(np.zeros(0, dtype=int), np.zeros(1, dtype=int), np.zeros(0, dtype=int),
+                       np.zeros(0, dtype=int), groups)
+        all_ids = np.concatenate([np.asarray(ids, dtype=int) for ids in group_ids])
+        group = np.concatenate([np.full(len(ids), ii, dtype=int) for ii, ids in enumerate(group_ids)])
+        row = np.concatenate([np.arange(len(ids)) for ids in group_ids])
+        # Sort by ID, group and row
+        srt = np.lexsort((row, group, all_ids))
+        ids, offsets = np.unique(all_ids[srt], return_index=True)
+        offsets = np.append(offsets, all_ids.size)
+        return cls(ids, offsets, group[srt], row[srt], groups)
+
+    @classmethod
+    def from_hdf(cls, hdf):
+        """ Load the index from a DB file
+
+        Parameters
+        ----------
+        hdf : h5py.File
+
+        Returns
+        -------
+        SpectraIndex or None
+          None if the DB file has no spectra index
+
+        """
+        from specdb.utils import decode_array
+        try:
+            sgrp = hdf[INDEX_GROUP+'/spectra']
+        except KeyError:
+            return None
+        return cls(sgrp['ids'][()], sgrp['offsets'][()], sgrp['group'][()], sgrp['row'][()],
+                   decode_array(sgrp['groups'][()]).tolist())
+
+    def write(self, hdf):
+        """ Write the index to a DB file
+
+        Parameters
+        ----------
+        hdf : h5py.File
+          Must be writeable
+        """
+        grp = hdf.require_group(INDEX_GROUP)
+        if 'spectra' in grp.keys():
+            del grp['spectra']
+        sgrp = grp.create_group('spectra')
+        sgrp['ids'] = self.ids
+        sgrp['offsets'] = self.offsets
+        sgrp['group'] = self.group.astype('int16')
+        sgrp['row'] = self.row
+        sgrp['groups'] = np.array([str(group).encode('utf-8') for group in self.groups], dtype=bytes)
+
+    def entries(self, IDs):
+        """ All spectra of a set of sources
+
+        Parameters
+        ----------
+        IDs : int ndarray
+
+        Returns
+        -------
+        group : int ndarray
+          Index into self.groups
+        row : int ndarray
+        source : int ndarray
+          Index into IDs of the source of each entry
+        """
+        IDs = np.atleast_1d(np.asarray(IDs, dtype=int))
+        i0 = np.searchsorted(self.ids, IDs)
+        found = i0 < self.ids.size
+        found[found] = self.ids[i0[found]] == IDs[found]
+        start = np.where(found, self.offsets[np.minimum(i0, self.ids.size)], 0)
+        end = np.where(found, self.offsets[np.minimum(i0+1, self.ids.size)], 0)
+        idx = ranges_to_indices(start, end)
+        source = np.repeat(np.arange(IDs.size), end-start)
+        return self.group[idx], self.row[idx], source
+
+    def rows_by_group(self, IDs):
+        """ Rows of the meta data of every group holding spectra of a set
+        of sources;  one lookup for all of the groups
+
+        Parameters
+        ----------
+        IDs : int ndarray
+
+        Returns
+        -------
+        rows : dict
+          Sorted, unique rows for each group of the index (empty if none)
+        """
+        igroup, rows, _ = self.entries(np.unique(IDs))
+        srt = np.lexsort((rows, igroup))
+        igroup, rows = igroup[srt], rows[srt]
+        bounds = np.searchsorted(igroup, np.arange(len(self.groups)+1))
+        return dict([(group, np.unique(rows[bounds[ii]:bounds[ii+1]]))
+                     for ii, group in enumerate(self.groups)])
+
+    def __len__(self):
+        return self.ids.size
+
+    def __repr__(self):
+        txt = '<{:s}: nsource={:d}, nspec={:d}, groups={}>'.format(
+            self.__class__.__name__, len(self), self.row.size, self.groups)
+        return (txt)
@@ -133,3 +133,17 @@ def test_ids_in_groups(igmsp):
     assert IDs4.size == 2
 
 
+
+
+def test_lazy():
+    db_file = data_path('IGMspec_DB_{:s}_debug.hdf5'.format(version))
+    igmsp = IgmSpec(db_file=db_file, lazy=True)
+    # ID lookups and matching do not load the catalog
+    coords = SkyCoord(ra=[0.0028,0.0019], dec=[14.9747,17.7737], unit='deg')
+    _, ccat, IDs = igmsp.qcat.query_coords(coords)
+    assert ccat['IGM_ID'][1] == 0
+    IDs2, _ = igmsp.qcat.find_ids_in_groups(['BOSS_DR12'])
+    assert IDs2.size == 19
+    assert igmsp.qcat._cat is None
+    # Full catalog on demand
+    assert len(igmsp.cat) == igmsp.qcat.nsource
@@ -32,6 +32,19 @@ def test_match_ids():
     assert mIDs[1] == 5
 
 
+def test_match_ids_index():
+    from specdb.column_index import ColumnIndex
+    rstate = np.random.RandomState(12)
+    tbl_IDs = rstate.permutation(1000)
+    index = ColumnIndex.from_column(tbl_IDs)
+    IDs = rstate.randint(0, 1200, 300)
+    for require in [True, False]:
+        if require:
+            IDs = IDs[IDs < 1000]
+        assert np.array_equal(index.match(IDs, require_in_match=require),
+                              cat_utils.match_ids(IDs, tbl_IDs, require_in_match=require))
+
+
 def test_flags_to_groups():
     # Dummy group dict
     gdict = dict(BOSS_DR12=1, SDSS_DR7=2, GGG=16)
@@ -41,3 +54,21 @@ def test_flags_to_groups():
     # Test
     for igroup in ['BOSS_DR12','GGG','SDSS_DR7']:
         assert igroup in groups[-1]
+
+
+def test_flags_to_membership():
+    gdict = dict(BOSS_DR12=1, SDSS_DR7=2, GGG=16)
+    flags = np.array([1,3,16,3,17,18,19,0])
+    # Scalar
+    assert sorted(cat_utils.flag_to_groups(18, gdict)) == ['GGG', 'SDSS_DR7']
+    assert cat_utils.flag_to_groups(0, gdict) == []
+    # Membership matrix
+    members, groups = cat_utils.flags_to_membership(flags, gdict)
+    assert members.shape == (8, 3)
+    assert np.array_equal(members[:, groups.index('SDSS_DR7')], (flags & 2) > 0)
+    # Categories
+    codes, categories = cat_utils.flags_to_categories(flags, gdict)
+    assert categories.size == 7
+    assert codes[1] == codes[3]
+    assert categories[codes[-1]] == ''
+    assert sorted(categories[codes[4]].split(',')) == ['BOSS_DR12', 'GGG']
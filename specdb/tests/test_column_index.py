@@ -0,0 +1,100 @@
+# Module to run tests on the column indexes and query plans
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+# TEST_UNICODE_LITERALS
+
+import pytest
+import numpy as np
+
+from astropy.table import Table
+
+from specdb.column_index import ColumnIndex, ColumnIndexes, ranges_to_indices
+from specdb import utils
+
+
+@pytest.fixture
+def tbl():
+    rstate = np.random.RandomState(1234)
+    nrow = 2000
+    tbl = Table()
+    tbl['IGM_ID'] = rstate.permutation(nrow)
+    tbl['zem'] = 5*rstate.rand(nrow)
+    tbl['zem'][::97] = np.nan
+    tbl['flag_group'] = rstate.randint(0, 16, nrow)
+    tbl['STYPE'] = np.array([b'QSO', b'GAL', b'STAR'])[rstate.randint(0, 3, nrow)]
+    tbl['R'] = rstate.choice([1000., 2000., 5000.], nrow)
+    return tbl
+
+
+def test_ranges_to_indices():
+    idx = ranges_to_indices(np.array([5, 0, 3]), np.array([7, 0, 4]))
+    assert np.array_equal(idx, [5, 6, 3])
+
+
+def test_column_index(tbl):
+    index = ColumnIndex.from_column(tbl['zem'])
+    rows = index.rows_between(1., 2.)
+    zem = tbl['zem'].data
+    assert np.array_equal(rows, np.where((zem >= 1.) & (zem <= 2.))[0])
+    assert index.rows_between(2., 1.).size == 0
+    # Membership
+    index2 = ColumnIndex.from_column(tbl['R'])
+    rows2 = index2.rows_in(np.array([2000., 3000.]))
+    assert np.array_equal(rows2, np.where(tbl['R'] == 2000.)[0])
+    assert index.rows_in(np.array([np.nan])).size == 0
+
+
+def test_stored_index(tbl, tmpdir):
+    import h5py
+    hdf = h5py.File(str(tmpdir.join('tmp_index.hdf5')), 'w')
+    grp = hdf.create_group('index')
+    for key in ['IGM_ID', 'STYPE']:
+        ColumnIndex.from_column(tbl[key]).write(grp, key)
+    indexes = ColumnIndexes(lambda key: tbl[key].data)
+    indexes.load(grp, decode=True)
+    assert 'STYPE' in indexes
+    # Match (as match_ids)
+    ids = np.array([10, 3, 10])
+    rows = indexes.get('IGM_ID').match(ids)
+    assert np.array_equal(tbl['IGM_ID'][rows], ids)
+    with pytest.raises(IOError):
+        indexes.get('IGM_ID').match(np.array([3, 2500]))
+    rows = indexes.get('IGM_ID').match(np.array([3, 2500]), require_in_match=False)
+    assert rows[1] == -1
+    # Decoded strings
+    index = indexes.get('STYPE')
+    assert index.values.dtype.kind == 'U'
+    assert np.array_equal(index.rows_in(np.array(['GAL'])), np.where(tbl['STYPE'] == b'GAL')[0])
+    hdf.close()
+
+
+def test_query_plan(tbl):
+    indexes = ColumnIndexes(lambda key: tbl[key].data, keys=['IGM_ID', 'zem', 'STYPE'])
+    qdicts = [{'zem': (3., 5.), 'STYPE': 'QSO'},
+              {'IGM_ID': [3, 10, 2500], 'flag_group-BITWISE-OR': [2, 4]},
+              {'flag_group-BITWISE-AND': [2, 4], 'R': [2000.]},
+              {'flag_group-BITWISE-OR': 1, 'zem': (2., 1.), 'IGM_ID': list(range(100))},
+              {'STYPE': ['GAL', 'STAR'], 'R': (1500., 6000.)}]
+    for qdict in qdicts:
+        match = utils.query_table(tbl, qdict)
+        match2 = utils.query_table(tbl, qdict, indexes=indexes)
+        assert np.array_equal(match, match2)
+        # Brute force
+        brute = np.ones(len(tbl), dtype=bool)
+        for key, value in qdict.items():
+            if 'BITWISE' in key:
+                col = tbl['flag_group'].data
+                if isinstance(value, int):
+                    brute &= (col & 2**value) > 0
+                elif 'OR' in key:
+                    brute &= np.any([(col & item) > 0 for item in value], axis=0)
+                else:
+                    brute &= np.all([(col & item) > 0 for item in value], axis=0)
+            elif isinstance(value, tuple):
+                brute &= (tbl[key] >= value[0]) & (tbl[key] <= value[1])
+            else:
+                brute &= np.in1d(tbl[key], np.array(value).astype(tbl[key].dtype))
+        assert np.array_equal(match, brute)
+    # Errors
+    with pytest.raises(IOError):
+        utils.query_table(tbl, {'zem': (1., 2., 3.)})
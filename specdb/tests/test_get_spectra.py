@@ -50,6 +50,22 @@ def test_spectra_from_meta(igmsp):  # Base level operation
     assert np.isclose(meta4['WV_MIN'][1], spec4.wvmin.value)
 
 
+def test_iter_spectra(igmsp):
+    meta = igmsp.meta_from_position((2.813500,14.767200), 20*u.deg)
+    idx = np.arange(15).astype(int)
+    idx[1] = 13
+    idx[13] = 1
+    meta = meta[idx]
+    nspec = 0
+    for sub_meta, data in igmsp.iter_spectra(meta, batch_size=4):
+        assert len(data) == len(sub_meta)
+        # Aligned with the input meta data
+        wvmin = [np.min(wave[wave > 0]) for wave in data['wave']]
+        assert np.allclose(wvmin, sub_meta['WV_MIN'], rtol=1e-3)
+        nspec += len(sub_meta)
+    assert nspec == 15
+
+
 def test_spectra_from_coord(igmsp):
     # No match
     specN, metaN = igmsp.spectra_from_coord((0.0019, -17.7737))
@@ -0,0 +1,31 @@
+# Module to run tests on the group membership index
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+# TEST_UNICODE_LITERALS
+
+import pytest
+import numpy as np
+
+from specdb.group_index import GroupIndex
+
+
+def test_group_index(tmpdir):
+    import h5py
+    gdict = dict(BOSS_DR12=1, SDSS_DR7=2, GGG=16)
+    flags = np.array([1, 3, 16, 3, 17, 18, 19, 0, 2, 1, 16])
+    gindex = GroupIndex.from_flags(flags, gdict)
+    # AND / OR
+    assert np.array_equal(gindex.select(['BOSS_DR12', 'SDSS_DR7']), (flags & 3) == 3)
+    assert np.array_equal(gindex.select(['BOSS_DR12', 'GGG'], in_all=False), (flags & 17) > 0)
+    rows = np.array([10, 0, 7, 6])
+    assert np.array_equal(gindex.contains('GGG', rows), [True, False, False, True])
+    # Write and read back;  built from the flags if missing
+    hdf = h5py.File(str(tmpdir.join('tmp_groups.hdf5')), 'w')
+    gindex.write(hdf)
+    del hdf['catalog_index/groups/GGG']
+    gindex2 = GroupIndex.from_hdf(hdf, group_dict=gdict, get_flags=lambda: flags)
+    hdf.close()
+    assert gindex2.nrow == flags.size
+    assert np.array_equal(gindex2.select(['GGG', 'SDSS_DR7'], in_all=False), (flags & 18) > 0)
+    with pytest.raises(IOError):
+        gindex2.bitmap('XX')
@@ -30,3 +30,145 @@ def test_show_meta():
     # Now with keys
     group_utils.show_group_meta(meta, meta_keys=['IGM_ID', 'RA_GROUP', 'zem_GROUP'])
 
+
+
+def test_plan_reads():
+    rows = np.array([7, 2, 3, 3, 10, 4])
+    urows, inv, runs = group_utils.plan_reads(rows)
+    assert np.array_equal(urows[inv], rows)
+    assert runs == [(0, 3), (3, 4), (4, 5)]
+    # Merge across gaps
+    _, _, runs2 = group_utils.plan_reads(rows, max_gap=2)
+    assert runs2 == [(0, 5)]
+
+
+def test_read_rows(tmpdir):
+    import h5py
+    hdf = h5py.File(str(tmpdir.join('tmp_rows.hdf5')), 'w')
+    data = np.zeros(200, dtype=[(str('flux'), 'f4', (5,)), (str('npix'), int)])
+    data['npix'] = np.arange(200)
+    dset = hdf.create_dataset('spec', data=data, chunks=(16,), compression='gzip')
+    rows = np.array([150, 3, 4, 5, 3, 199, 20])
+    for max_gap in [None, 0, 100]:
+        sub = group_utils.read_rows(dset, rows, max_gap=max_gap)
+        assert np.array_equal(sub['npix'], rows)
+    hdf.close()
+
+
+def test_read_rows_threaded(tmpdir):
+    import h5py
+    from concurrent.futures import ThreadPoolExecutor
+    hdf = h5py.File(str(tmpdir.join('tmp_threads.hdf5')), 'w')
+    data = np.zeros(100, dtype=[(str('flux'), 'f4', (5,)), (str('npix'), int)])
+    data['npix'] = np.arange(100)
+    data['flux'] = np.random.RandomState(1).rand(100, 5)
+    hdf.create_dataset('gzip', data=data, chunks=(16,), compression='gzip', shuffle=True)
+    hdf.create_dataset('lzf', data=data, chunks=(16,), compression='lzf')
+    assert group_utils.chunk_filters(hdf['lzf']) is None
+    rows = np.array([99, 3, 4, 5, 3, 40, 20])
+    pool = ThreadPoolExecutor(max_workers=3)
+    for key in ['gzip', 'lzf']:  # lzf falls back to h5py
+        sub = group_utils.read_rows(hdf[key], rows, pool=pool)
+        assert np.array_equal(sub, data[rows])
+    pool.shutdown()
+    hdf.close()
+
+
+def test_read_rows_sharded(tmpdir):
+    import h5py
+    from concurrent.futures import ProcessPoolExecutor
+    db_file = str(tmpdir.join('tmp_shards.hdf5'))
+    hdf = h5py.File(db_file, 'w')
+    data = np.zeros(100, dtype=[(str('flux'), 'f4', (5,)), (str('npix'), int)])
+    data['npix'] = np.arange(100)
+    hdf.create_group('TEST').create_dataset('spec', data=data, chunks=(16,), compression='gzip')
+    hdf.close()
+    rows = np.array([99, 3, 4, 5, 3, 40, 20, 60])
+    pool = ProcessPoolExecutor(max_workers=2)
+    sub = group_utils.read_rows_sharded(pool, db_file, 'TEST', rows, data.dtype,
+                                        chunk_rows=16, nshard=3)
+    assert np.array_equal(sub, data[rows])
+    # Default shards, from the size of the pool
+    sub = group_utils.read_rows_sharded(pool, db_file, 'TEST', rows, data.dtype,
+                                        chunk_rows=16, processes=2)
+    pool.shutdown()
+    assert np.array_equal(sub, data[rows])
+
+
+def test_memmap_spec(tmpdir):
+    import h5py
+    hdf = h5py.File(str(tmpdir.join('tmp_memmap.hdf5')), 'w')
+    data = np.zeros(50, dtype=[(str('flux'), 'f4', (5,)), (str('npix'), int)])
+    data['npix'] = np.arange(50)
+    hdf.create_dataset('contiguous', data=data)
+    hdf.create_dataset('chunked', data=data, chunks=(16,), compression='gzip')
+    assert group_utils.memmap_spec(hdf['chunked']) is None
+    spec = group_utils.memmap_spec(hdf['contiguous'])
+    assert isinstance(spec, np.memmap)
+    assert np.array_equal(spec[[7, 3]], data[[7, 3]])
+    hdf.close()
+
+
+def test_memory_budget():
+    import gc
+    budget = group_utils.MemoryBudget(1e-6)  # 1000 bytes
+    # Output of 500 bytes, read 200 bytes per row
+    batches = budget.batches(5, 200, 500)
+    assert len(batches) == 3
+    assert batches[-1] == slice(4, 6)
+    assert budget.batches(5, 200, 900) is None
+    # Output streamed:  200 bytes read + 100 bytes out per row
+    batches = budget.batches(5, 300, 0)
+    assert batches == [slice(0, 3), slice(3, 6)]
+    assert budget.batches(0, 200, 0) == []
+    # Ledger
+    arr = np.zeros(100)
+    budget.hand_out(arr, arr.nbytes)
+    assert budget.available == 200
+    del arr
+    gc.collect()
+    assert budget.nbytes == 0
+
+
+def test_row_cache(tmpdir):
+    import h5py
+    hdf = h5py.File(str(tmpdir.join('tmp_cache.hdf5')), 'w')
+    data = np.zeros(100, dtype=[(str('flux'), 'f4', (5,)), (str('npix'), int)])
+    data['npix'] = np.arange(100)
+    dset = hdf.create_dataset('spec', data=data, chunks=(16,), compression='gzip')
+    # Budget of 4 rows
+    cache = group_utils.RowCache(4*data.dtype.itemsize)
+    sub = cache.read(dset, np.array([5, 3, 5]))
+    assert np.array_equal(sub['npix'], [5, 3, 5])
+    assert cache.misses == 2
+    sub = cache.read(dset, np.array([3, 7]))
+    assert np.array_equal(sub['npix'], [3, 7])
+    assert cache.hits == 1
+    # Eviction (least recently used is 5)
+    cache.read(dset, np.array([8, 9]))
+    assert len(cache) == 4
+    assert 5 not in cache
+    assert 3 in cache
+    hdf.close()
+
+
+def test_wave_solution():
+    # Log-linear (SDSS-like)
+    loglam = 3.5800 + 1e-4*np.arange(4000)
+    wave = (10**loglam).astype(np.float32).astype(float)
+    wtype, wv0, dwv = group_utils.fit_wave_solution(wave)
+    assert wtype == group_utils.WAVE_LOGLINEAR
+    # Linear
+    wtype2, _, _ = group_utils.fit_wave_solution(3000. + 0.5*np.arange(2000))
+    assert wtype2 == group_utils.WAVE_LINEAR
+    # Neither
+    wtype3, _, _ = group_utils.fit_wave_solution(3000. + 0.5*np.arange(2000)**1.1)
+    assert wtype3 == group_utils.WAVE_EXPLICIT
+    # Synthesize, with padding
+    solution = np.zeros(2, dtype=group_utils.wave_solution_dtype)
+    solution[0] = (wtype, wv0, dwv, 4000, 0)
+    solution[1] = (group_utils.WAVE_EXPLICIT, 0., 0., 100, 0)
+    swave = group_utils.synthesize_wave(solution, 4100)
+    assert np.max(np.abs(swave[0, :4000]-wave)/np.gradient(wave)) < 0.01
+    assert np.all(swave[0, 4000:] == 0.)
+    assert np.all(swave[1] == 0.)
@@ -102,3 +102,19 @@ def test_spec_from_meta():
     imeta = meta[rows]
     spec = boss_group.spec_from_meta(imeta)
     assert spec.nspec == 5
+
+
+def test_meta_columns():
+    db_file = data_path('IGMspec_DB_{:s}_debug.hdf5'.format(version))
+    hdf = h5py.File(db_file, 'r')
+    boss_group = InterfaceGroup(hdf, 'BOSS_DR12', 'IGM_ID', meta_columns=['zem_GROUP'])
+    assert set(boss_group.meta.keys()) == set(['zem_GROUP', 'GROUP_ID', 'IGM_ID'])
+    # Query loads only the columns it needs
+    matches, sub_meta, IDs = boss_group.query_meta({'zem_GROUP': (3., 5.), 'R': (1000., 3000.)})
+    assert 'R' in boss_group.meta.keys()
+    assert 'SPEC_FILE' not in boss_group.meta.keys()
+    # Same answer as the full table
+    full_group = InterfaceGroup(hdf, 'BOSS_DR12', 'IGM_ID')
+    _, _, IDs2 = full_group.query_meta({'zem_GROUP': (3., 5.), 'R': (1000., 3000.)})
+    assert np.array_equal(IDs, IDs2)
+    hdf.close()
@@ -97,29 +97,42 @@ def test_meta_from_coords(igmsp):
     assert np.sum(meta5['GROUP_ID'] == meta5['GROUP_ID']) == 2
     # Multiple hits on single source with first=False
     coord = SkyCoord(ra=2.813458, dec=14.767167, unit='deg')
-    _, meta6_list, meta6_stack = igmsp.meta_from_coords(coord, first=False)
-    assert len(meta6_list) == 1
-    meta6_0 = meta6_stack[meta6_list[0]]
+    _, meta6_off, meta6_stack = igmsp.meta_from_coords(coord, first=False)
+    assert len(meta6_off) == 2
+    meta6_0 = meta6_stack[meta6_off[0]:meta6_off[1]]
     assert len(meta6_0) == 2
     assert meta6_0['GROUP_ID'][0] == 0
+    # As a list of masks
+    _, meta6_list, meta6_stack = igmsp.meta_from_coords(coord, first=False, masks=True)
+    assert len(meta6_list) == 1
+    assert len(meta6_stack[meta6_list[0]]) == 2
     # Multiple hits on two sources with first=False
     coords = SkyCoord(ra=[0.0028,2.813458], dec=[14.9747,14.767167], unit='deg')
-    matches7, meta7_list, meta7_stack = igmsp.meta_from_coords(coords, first=False)
-    assert len(meta7_stack[meta7_list[0]]) == 1
-    assert len(meta7_stack[meta7_list[1]]) == 2
+    matches7, meta7_off, meta7_stack = igmsp.meta_from_coords(coords, first=False)
+    assert np.array_equal(np.diff(meta7_off), [1, 2])
+    assert len(meta7_stack) == 3
     assert np.sum(matches7) == 2
     # Multiple hits on two sources with first=False; limit by groups
     coords = SkyCoord(ra=[0.0028,2.813458], dec=[14.9747,14.767167], unit='deg')
-    matches7b, meta7b_list, meta7b_stack = igmsp.meta_from_coords(coords, first=False, groups=['GGG'])
-    assert meta7b_list[0] is None
+    matches7b, meta7b_off, meta7b_stack = igmsp.meta_from_coords(coords, first=False, groups=['GGG'])
+    assert meta7b_off[1] == meta7b_off[0]
     # Multiple hits on mixed sources with first=False
     coords = SkyCoord(ra=[0.0028,9.99,2.813458], dec=[14.9747,-9.99,14.767167], unit='deg')
-    matches8, meta8_list, meta8_stack = igmsp.meta_from_coords(coords, first=False)
-    assert meta8_list[1] is None
+    matches8, meta8_off, meta8_stack = igmsp.meta_from_coords(coords, first=False)
+    assert meta8_off[2] == meta8_off[1]
     assert np.sum(matches8) == 2
     # Limit by groups
-    matches8b, meta8b_list, _ = igmsp.meta_from_coords(coords, first=False, groups=['GGG'])
+    matches8b, meta8b_list, _ = igmsp.meta_from_coords(coords, first=False, groups=['GGG'], masks=True)
     assert meta8b_list[0] is None
+    # No match with first=False;  same outputs as a match
+    coord = SkyCoord(ra=0.0019, dec=-17.7737, unit='deg')
+    matches9, meta9_off, meta9_stack = igmsp.meta_from_coords(coord, first=False)
+    assert np.sum(matches9) == 0
+    assert np.array_equal(meta9_off, [0, 0])
+    assert meta9_stack is None
+    matches9b, meta9b_list, meta9b_stack = igmsp.meta_from_coords(coord, first=False, masks=True)
+    assert meta9b_list == [None]
+    assert meta9b_stack is None
     # Limit by qdict
     qdict = dict(DISPERSER='R400')
 
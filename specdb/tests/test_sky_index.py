@@ -0,0 +1,100 @@
+# Module to run tests on the sky index
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+# TEST_UNICODE_LITERALS
+
+import pytest
+import numpy as np
+import h5py
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord, match_coordinates_sky
+
+from specdb.sky_index import SkyIndex, CoordTree
+
+
+@pytest.fixture
+def radec():
+    rstate = np.random.RandomState(1234)
+    ra = 360.*rstate.rand(20000)
+    dec = np.degrees(np.arcsin(2*rstate.rand(20000)-1.))
+    return ra, dec
+
+
+def brute_force(ra, dec, coord, radius):
+    sep = coord.separation(SkyCoord(ra=ra, dec=dec, unit='deg'))
+    return np.where(sep < radius)[0]
+
+
+def test_query_radius(radec):
+    ra, dec = radec
+    sky_index = SkyIndex.from_radec(ra, dec)
+    # Includes RA wrap and near-pole positions
+    for ra0, dec0, rad in [(10., 20., 1.), (0.1, -5., 2.), (359.8, 45., 3.),
+                           (180., 89.5, 2.), (45., -88., 5.), (ra[7], dec[7], 1./3600)]:
+        coord = SkyCoord(ra=ra0, dec=dec0, unit='deg')
+        rows, sep = sky_index.query_radius(coord, rad*u.deg)
+        assert np.array_equal(rows, brute_force(ra, dec, coord, rad*u.deg))
+        assert np.all(sep < rad*u.deg)
+    # Self match
+    rows, _ = sky_index.query_radius(SkyCoord(ra=ra[7], dec=dec[7], unit='deg'), 1*u.arcsec)
+    assert 7 in rows
+
+
+def test_hdf(radec, tmpdir):
+    ra, dec = radec
+    tmp_file = str(tmpdir.join('tmp_sky.hdf5'))
+    sky_index = SkyIndex.from_radec(ra, dec, zone_height=0.5)
+    # Write
+    hdf = h5py.File(tmp_file, 'w')
+    sky_index.write(hdf)
+    hdf.close()
+    # Read and query from disk
+    hdf = h5py.File(tmp_file, 'r')
+    sky_index2 = SkyIndex.from_hdf(hdf, in_memory=False)
+    assert len(sky_index2) == ra.size
+    coord = SkyCoord(ra=100., dec=-30., unit='deg')
+    rows, _ = sky_index2.query_radius(coord, 2*u.deg)
+    assert np.array_equal(rows, brute_force(ra, dec, coord, 2*u.deg))
+    hdf.close()
+
+
+def test_coord_tree(radec):
+    ra, dec = radec
+    coord_tree = CoordTree.from_radec(ra, dec)
+    cat = SkyCoord(ra=ra, dec=dec, unit='deg')
+    # Match against astropy
+    coords = cat[::100]
+    idx, d2d = coord_tree.match(coords)
+    aidx, ad2d, _ = match_coordinates_sky(coords, cat)
+    assert np.array_equal(idx, aidx)
+    # nthneighbor
+    idx2, d2d2 = coord_tree.match(coords, nthneighbor=2)
+    aidx2, ad2d2, _ = match_coordinates_sky(coords, cat, nthneighbor=2)
+    assert np.array_equal(idx2, aidx2)
+    assert np.allclose(d2d2.to('arcsec').value, ad2d2.to('arcsec').value)
+    # Scalar input
+    idx3, _ = coord_tree.match(cat[3])
+    assert idx3.shape == (1,)
+    assert idx3[0] == 3
+
+
+def test_coord_tree_sidecar(radec, tmpdir):
+    ra, dec = radec
+    tmp_file = str(tmpdir.join('tmp_tree.npz'))
+    key = dict(CREATION_DATE='2017-Jan-01', VERSION='v01')
+    coord_tree = CoordTree.from_radec(ra, dec, key=key)
+    coord_tree.save(tmp_file)
+    # Reload
+    coord_tree2 = CoordTree.load(tmp_file, key=key)
+    assert len(coord_tree2) == ra.size
+    assert np.array_equal(coord_tree2.match(SkyCoord(ra=ra[:50], dec=dec[:50], unit='deg'))[0],
+                          np.arange(50))
+    # Stale
+    assert CoordTree.load(tmp_file, key=dict(CREATION_DATE='2018-Jan-01', VERSION='v02')) is None
+    # Pickles are not read
+    import pickle
+    pkl_file = str(tmpdir.join('tmp_tree.pkl'))
+    with open(pkl_file, 'wb') as f:
+        pickle.dump(dict(key=key, tree=coord_tree.tree), f)
+    assert CoordTree.load(pkl_file, key=key) is None
@@ -0,0 +1,33 @@
+# Module to run tests on the spectra index
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+# TEST_UNICODE_LITERALS
+
+import pytest
+import numpy as np
+
+from specdb.spectra_index import SpectraIndex
+
+
+def test_spectra_index(tmpdir):
+    import h5py
+    group_ids = [np.array([5, 2, 5, 7]), np.array([], dtype=int), np.array([7, 1])]
+    index = SpectraIndex.from_ids(group_ids, ['A', 'B', 'C'])
+    assert np.array_equal(index.ids, [1, 2, 5, 7])
+    # Write and read back
+    hdf = h5py.File(str(tmpdir.join('tmp_spec_index.hdf5')), 'w')
+    index.write(hdf)
+    index = SpectraIndex.from_hdf(hdf)
+    hdf.close()
+    assert index.groups == ['A', 'B', 'C']
+    # Entries, ordered by group and row
+    group, row, source = index.entries(np.array([7, 3, 5]))
+    assert np.array_equal(group, [0, 2, 0, 0])
+    assert np.array_equal(row, [3, 0, 0, 2])
+    assert np.array_equal(source, [0, 0, 2, 2])
+    # Rows, group by group
+    rows = index.rows_by_group([5, 7, 5, 3])
+    assert sorted(rows.keys()) == ['A', 'B', 'C']
+    assert np.array_equal(rows['A'], [0, 2, 3])
+    assert rows['B'].size == 0
+    assert np.array_equal(rows['C'], [0])
@@ -38,3 +38,14 @@ def test_clean_vstack(igmsp):
         tigmsp = IgmSpec()
         run_tst(tigmsp)
 
+
+
+def test_hdf_decode():
+    arr = np.zeros(3, dtype=[(str('ID'), int), (str('INSTR'), 'S8'), (str('NAME'), 'S8')])
+    arr['INSTR'] = [b'ESI', b'HIRES', b'']
+    arr['NAME'] = ['J1234'.encode('utf-8'), 'Qé'.encode('utf-8'), b'x']
+    tbl = utils.hdf_decode(arr, itype='Table')
+    assert tbl['INSTR'][1] == 'HIRES'
+    assert tbl['INSTR'][2] == ''
+    assert tbl['NAME'][1] == 'Qé'
+    assert tbl['ID'].dtype == arr['ID'].dtype
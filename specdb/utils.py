@@ -82,7 +82,7 @@ def hdf_decode(obj, itype=None):
         # FIX STRING COLUMNS
         for key in dobj.keys():
             if 'bytes' in dobj[key].dtype.name:
-                ss = [hdf_decode(ii) for ii in dobj[key]]
+                ss = decode_array(dobj[key].data)
                 # Remove
                 dobj.remove_column(key)
                 # Add back
@@ -95,6 +95,24 @@ def hdf_decode(obj, itype=None):
         #
     return dobj
 
+def decode_array(arr):
+    """ Decode an array of byte strings to str, all at once
+
+    Parameters
+    ----------
+    arr : ndarray
+      dtype of bytes (S)
+
+    Returns
+    -------
+    darr : ndarray
+      dtype of str (U)
+    """
+    try:  # Fast, ASCII only
+        return arr.astype('U')
+    except UnicodeDecodeError:
+        return np.char.decode(arr, 'utf-8')
+
 def load_db(db_type, **kwargs):
     """
     Parameters
@@ -126,15 +144,34 @@ def load_db(db_type, **kwargs):
     return Specdb
 
 
-def query_table(tbl, qdict, ignore_missing_keys=True, verbose=True,
-                tbl_name=''):
-    """ Find all rows in the input table satisfying
-    the query given by qdict
+def query_keys(qdict):
+    """ Table keys referenced by a query_dict
+
     Parameters
     ----------
-    tbl : Table
     qdict : dict
-      See query_dict documentation for rules
+
+    Returns
+    -------
+    keys : list
+    """
+    keys = []
+    for key in qdict.keys():
+        if '-BITWISE' in key:
+            key = key[:key.rfind('-BITWISE')]
+        keys.append(key)
+    return keys
+
+
+def compile_query(qdict, tkeys, ignore_missing_keys=True, verbose=True, tbl_name=''):
+    """ Compile a query_dict into a list of predicates
+    See query_dict documentation for rules
+
+    Parameters
+    ----------
+    qdict : dict
+    tkeys : list
+      Keys of the Table to be queried
     ignore_missing_keys : bool, optional
       Ignores any keys in the query_dict not found in Table
       Otherwise, throw an IOError
@@ -143,14 +180,14 @@ def query_table(tbl, qdict, ignore_missing_keys=True, verbose=True,
 
     Returns
     -------
-    match : bool ndarray
-        True = Row satisfies the query
+    plan : list of tuple
+      (key, op, value) with op one of
+        'range' -- value is (min, max)
+        'in' -- value is a scalar or list
+        'bit' -- value is the bit number
+        'bit_or', 'bit_and' -- value is a list of flags
     """
-    # Init
-    match = np.array([True]*len(tbl))
-    tkeys = tbl.keys()
-
-    # Perform
+    plan = []
     for key,value in qdict.items():
         # Deal with BITWISE
         if '-BITWISE' in key:
@@ -178,32 +215,138 @@ def query_table(tbl, qdict, ignore_missing_keys=True, verbose=True,
             # Check
             if len(value) != 2:
                 raise IOError("Tuple for key={:s} in query_dict must have length 2 for min/max".format(key))
-            # Min/Max
-            match = match & (tbl[key].data >= value[0]) & (tbl[key].data <= value[1])
+            plan.append((key, 'range', value))
         elif isinstance(value,(list,float,basestring,int)):
             if flg_bitwise > 0: # BITWISE
                 if isinstance(value,(int)):
-                    match &= (tbl[key].data & 2**value).astype(bool)
+                    plan.append((key, 'bit', value))
                 elif isinstance(value,(list)):
-                    if flg_bitwise == 1:
-                        bit_match = np.array([False]*len(tbl))
-                    else:
-                        bit_match = np.array([True]*len(tbl))
-                    for item in value:
-                        if flg_bitwise == 1: # OR
-                            bit_match += (tbl[key].data & item).astype(bool)
-                        else: # AND
-                            bit_match &= (tbl[key].data & item).astype(bool)
-                    try:
-                        match &= bit_match
-                    except TypeError:
-                        pdb.set_trace()
+                    plan.append((key, 'bit_or' if flg_bitwise == 1 else 'bit_and', value))
             else:
-                # Recast
-                mlist = np.array(value).astype(tbl[key].dtype)
-                # Match
-                match &= np.in1d(tbl[key].data, mlist)
+                plan.append((key, 'in', value))
         else:
             raise IOError("Bad data type for query_dict value: {}".format(type(value)))
+    return plan
+
+
+def eval_predicate(op, value, data):
+    """ Evaluate one predicate of a query plan
+
+    Parameters
+    ----------
+    op : str
+    value : object
+    data : ndarray
+      Column values
+
+    Returns
+    -------
+    keep : bool ndarray
+    """
+    if op == 'range':
+        return (data >= value[0]) & (data <= value[1])
+    elif op == 'in':
+        # Recast
+        mlist = np.array(value).astype(data.dtype)
+        return np.in1d(data, mlist)
+    elif op == 'bit':
+        return (data & 2**value).astype(bool)
+    elif op == 'bit_or':  # Any bit of any of the flags
+        return (data & np.bitwise_or.reduce(np.atleast_1d(value).astype(data.dtype))) != 0
+    elif op == 'bit_and':
+        flags = np.atleast_1d(value).astype(data.dtype)
+        if np.all((flags > 0) & ((flags & (flags-1)) == 0)):  # Single bits;  one mask
+            mask = np.bitwise_or.reduce(flags)
+            return (data & mask) == mask
+        keep = np.ones(len(data), dtype=bool)
+        for item in flags:
+            keep &= (data & item).astype(bool)
+        return keep
+    else:
+        raise IOError("Bad query operation: {:s}".format(op))
+
+
+def run_query(plan, nrow, get_column, indexes=None):
+    """ Evaluate a compiled query plan
+
+    Predicates that can use a sorted column index go first,
+    then membership, range and bitwise tests.  Each predicate
+    after the first is only evaluated on the rows that survive,
+    and the loop stops once none do.
+
+    Parameters
+    ----------
+    plan : list
+      From compile_query
+    nrow : int
+      Number of rows in the Table
+    get_column : callable
+      Returns the column (ndarray) for a key
+    indexes : ColumnIndexes or dict, optional
+      Sorted indexes of the columns
+
+    Returns
+    -------
+    match : bool ndarray
+        True = Row satisfies the query
+    """
+    op_rank = {'in': 0, 'range': 1, 'bit': 2, 'bit_or': 2, 'bit_and': 2}
+    def get_index(key, op):
+        if (indexes is None) or (op not in ['in', 'range']):
+            return None
+        return indexes.get(key)
+    order = sorted(range(len(plan)), key=lambda ii: (get_index(*plan[ii][0:2]) is None,
+                                                     op_rank[plan[ii][1]], ii))
+    # Loop on the predicates
+    rows = None  # All of them
+    for ii in order:
+        key, op, value = plan[ii]
+        if (rows is not None) and (rows.size == 0):
+            break
+        index = get_index(key, op)
+        if (index is not None) and (rows is None):
+            if op == 'in':
+                rows = index.rows_in(np.atleast_1d(np.array(value).astype(index.values.dtype)))
+            else:
+                rows = index.rows_between(value[0], value[1])
+            continue
+        # Scan the surviving rows
+        column = get_column(key)
+        if rows is None:
+            rows = np.where(eval_predicate(op, value, column))[0]
+        else:
+            rows = rows[eval_predicate(op, value, column[rows])]
     # Return
+    match = np.zeros(nrow, dtype=bool)
+    if rows is None:
+        match[:] = True
+    else:
+        match[rows] = True
     return match
+
+
+def query_table(tbl, qdict, ignore_missing_keys=True, verbose=True,
+                tbl_name='', indexes=None):
+    """ Find all rows in the input table satisfying
+    the query given by qdict
+    Parameters
+    ----------
+    tbl : Table
+    qdict : dict
+      See query_dict documentation for rules
+    ignore_missing_keys : bool, optional
+      Ignores any keys in the query_dict not found in Table
+      Otherwise, throw an IOError
+    tbl_name : str, optional
+      Name of table.  Mainly for error message
+    indexes : ColumnIndexes or dict, optional
+      Sorted indexes of the columns of the Table
+
+    Returns
+    -------
+    match : bool ndarray
+        True = Row satisfies the query
+    """
+    plan = compile_query(qdict, tbl.keys(), ignore_missing_keys=ignore_missing_keys,
+                         verbose=verbose, tbl_name=tbl_name)
+    return run_query(plan, len(tbl), lambda key: tbl[key].data, indexes=indexes)